@@ -1,25 +1,44 @@
-from dataclasses import dataclass
-from pickle import dump, HIGHEST_PROTOCOL
-from struct import unpack, pack
-from typing import Iterable
-
-from vphys_parser import VphysParser
-
-
-
-@dataclass
-class Vec3:
-    x: float
-    y: float
-    z: float
-
-@dataclass
-class Triangle:
-    p1: Vec3
-    p2: Vec3
-    p3: Vec3
-
-@dataclass
+from argparse import ArgumentParser
+from collections import Counter
+from dataclasses import dataclass, field
+from hashlib import sha256
+from itertools import product
+from os import listdir, remove
+from os.path import basename, dirname, exists, join
+from pickle import dump, load, HIGHEST_PROTOCOL, UnpicklingError
+from re import escape, fullmatch
+from struct import unpack
+from typing import Final
+
+from numpy import (
+    arange, argsort, array, bincount, concatenate, cross, cumsum, dtype, floor, frombuffer, float32, float64, inf, int32, int64,
+    lexsort, minimum, ndarray, sort, split, sqrt, stack, uint32, unique, where, zeros
+)
+from numpy.linalg import norm
+
+from example.visibility_check.convex_hull import ConvexHulls
+from example.visibility_check.index_file import write_index_file
+from example.visibility_check.kd_tree import KdTree
+from vphys_c_parser import VphysBinaryParser
+from vphys_parser import VphysDict, VphysList, VphysParser
+
+
+# RnNode_t: m_vMin, m_nChildren, m_vMax, m_nTriangleOffset
+# low 2 bits of m_nChildren are the split axis, 3 marks a leaf, the rest is the right child offset or leaf triangle count
+RN_NODE: Final = dtype([("min", "<f4", 3), ("children", "<u4"), ("max", "<f4", 3), ("triangle_offset", "<u4")])
+RN_NODE_LEAF: Final[int] = 3
+
+# vertices closer than this are merged into one entry of the map vertex buffer
+WELD_EPSILON: Final[float] = 1e-3
+WELD_NEIGHBOURS: Final[tuple[tuple[int, int, int], ...]] = tuple(product((0, -1, 1), repeat=3))
+WELD_CELL_HASH: Final[tuple[int, int, int]] = (73856093, 19349663, 83492791)
+
+# optional simplification, triangles thinner than this are dropped and coplanar neighbours merged within it
+SIMPLIFY_EPSILON: Final[float] = 1e-2
+
+
+
+@dataclass(slots=True)
 class Edge:
     next: int
     twin: int
@@ -51,117 +70,599 @@ class BytesFactory:
 
         return bytes_list
 
-def write_pkl(file_name: str, triangles: Iterable[Triangle]) -> None:
-    with open(f"{file_name}.pkl", "wb") as file:
-        dump(triangles, file, protocol=HIGHEST_PROTOCOL)
-
-def write_tri(file_name: str, triangles: Iterable[Triangle]) -> None:
-    byte_raw = list()
-    for triangle in triangles:
-        for point in (triangle.p1, triangle.p2, triangle.p3):
-            byte_raw.append(point.x)
-            byte_raw.append(point.y)
-            byte_raw.append(point.z)
-    triangles_byte = " ".join([
-        pack("f", i).hex(" ").upper()
-        for i in byte_raw
-    ])
-    with open(f"{file_name}.tri", "w") as file:
-        file.write(triangles_byte)
+def decode_mesh_nodes(nodes_raw: bytes, triangle_count: int) -> tuple[ndarray, ndarray, ndarray]:
+    nodes = frombuffer(nodes_raw, dtype=RN_NODE)
+    if len(nodes) == 0: raise ValueError("Mesh has no nodes.")
+
+    index = arange(len(nodes), dtype=int32)
+    is_leaf = (nodes["children"] & 3) == RN_NODE_LEAF
+    payload = (nodes["children"] >> 2).astype(int32)
+
+    node_child = stack((
+        where(is_leaf, -1, index + 1),
+        where(is_leaf, -1, index + payload)
+    ), axis=1).astype(int32)
+    node_triangle = zeros((len(nodes), 2), dtype=int32)
+    node_triangle[is_leaf] = stack((nodes["triangle_offset"][is_leaf].astype(int32), payload[is_leaf]), axis=1)
+
+    if (
+        (node_child >= len(nodes)).any() or
+        ((node_child >= 0) & (node_child <= index[:, None])).any() or
+        (node_triangle[:, 0].astype(uint32) + node_triangle[:, 1] > triangle_count).any()
+    ): raise ValueError("Mesh nodes are malformed.")
+
+    return stack((nodes["min"], nodes["max"]), axis=1), node_child, node_triangle
+
+def hull_face_normals(vertices: ndarray, faces_raw: bytes, edges_raw: bytes) -> ndarray:
+    edges = list()
+    edges_merged = BytesFactory.bytes_merge(edges_raw, 1)
+    for i in range(len(edges_merged) // 4):
+        i *= 4
+        edges.append(Edge(
+            BytesFactory.uint8(edges_merged[i]),
+            BytesFactory.uint8(edges_merged[i + 1]),
+            BytesFactory.uint8(edges_merged[i + 2]),
+            BytesFactory.uint8(edges_merged[i + 3])
+        ))
+
+    normals = list()
+    for start_edge in faces_raw:
+        # newell normal of the face loop
+        normal = zeros(3, dtype=float32)
+        edge = start_edge
+        while True:
+            current, following = vertices[edges[edge].origin], vertices[edges[edges[edge].next].origin]
+            normal += cross(current, following)
+            edge = edges[edge].next
+            if edge == start_edge: break
+        normals.append(normal / sqrt((normal ** 2).sum()))
+    return array(normals, dtype=float32)
+
+
+@dataclass(slots=True)
+class CollisionMesh:
+    vertices: ndarray
+    triangles: ndarray
+    nodes: tuple[ndarray, ndarray, ndarray] | None
+
+    # triangles as indices into the welded vertex buffer of the map, see index_geometry
+    indices: ndarray | None = None
+    # content hash of the source container, and the spatial index of this mesh alone, kept for incremental updates
+    content_hash: bytes = b""
+    kd_tree: KdTree | None = None
+
+    def to_cache(self) -> tuple:
+        # plain values only, a pickled class would be bound to the module that wrote it, e.g. __main__
+        kd_tree = (self.kd_tree.geometry_hash, self.kd_tree.to_arrays()) if self.kd_tree is not None else None
+        return self.vertices, self.triangles, self.nodes, self.indices, self.content_hash, kd_tree
+
+    @classmethod
+    def from_cache(cls, cache: tuple) -> "CollisionMesh":
+        vertices, triangles, nodes, indices, content_hash, kd_tree = cache
+        return cls(vertices, triangles, nodes, indices, content_hash, KdTree.from_arrays(*kd_tree) if kd_tree is not None else None)
+
+@dataclass(slots=True)
+class CollisionLayer:
+    part: int
+    attribute_index: int
+    attribute_name: str
+
+    meshes: list[CollisionMesh] = field(default_factory=list)
+    hull_planes: list[ndarray] = field(default_factory=list)
+    hull_bboxes: list[tuple[ndarray, ndarray]] = field(default_factory=list)
+    hull_hashes: list[bytes] = field(default_factory=list)
+
+    def to_cache(self) -> tuple:
+        return (
+            self.part, self.attribute_index, self.attribute_name,
+            [mesh.to_cache() for mesh in self.meshes], self.hull_planes, self.hull_bboxes, self.hull_hashes
+        )
+
+    @classmethod
+    def from_cache(cls, cache: tuple) -> "CollisionLayer":
+        part, attribute_index, attribute_name, meshes, hull_planes, hull_bboxes, hull_hashes = cache
+        return cls(part, attribute_index, attribute_name, [CollisionMesh.from_cache(mesh) for mesh in meshes], hull_planes, hull_bboxes, hull_hashes)
+
+    def get_content_hashes(self) -> tuple[list[bytes], list[bytes]]:
+        return self.hull_hashes, [mesh.content_hash for mesh in self.meshes]
+
+    def get_convex_hulls(self, simplify: bool = False) -> ConvexHulls:
+        hull_planes, hull_bboxes = self.hull_planes, self.hull_bboxes
+        if simplify:
+            # hulls with identical planes only need to be tested once
+            first = {planes.tobytes(): index for index, planes in reversed(tuple(enumerate(hull_planes)))}
+            hull_planes = [hull_planes[index] for index in sorted(first.values())]
+            hull_bboxes = [hull_bboxes[index] for index in sorted(first.values())]
+
+        hull_plane = zeros((len(hull_planes), 2), dtype=int32)
+        hull_plane[:, 1] = [len(planes) for planes in hull_planes]
+        hull_plane[1:, 0] = cumsum(hull_plane[:-1, 1])
+
+        return ConvexHulls(
+            concatenate(hull_planes) if hull_planes else zeros((0, 4), dtype=float32),
+            hull_plane,
+            array(hull_bboxes, dtype=float32).reshape((-1, 2, 3))
+        )
+
+    def get_indices(self) -> ndarray:
+        return concatenate([mesh.indices for mesh in self.meshes]) if self.meshes else zeros((0, 3), dtype=int32)
+
+    def get_kd_tree(self, vertices: ndarray, weld_epsilon: float) -> KdTree | None:
+        # one subtree per mesh, meshes kept from a previous extraction only get merged again
+        # meshes simplified down to nothing stay in the layer for their content hash but have no subtree
+        meshes = [mesh for mesh in self.meshes if len(mesh.indices) > 0]
+        for mesh in meshes:
+            if mesh.kd_tree is not None: continue
+
+            triangle_buffer = vertices[mesh.indices]
+            if mesh.nodes is None:
+                kd_tree = KdTree.from_triangle_buffer(triangle_buffer)
+                mesh.kd_tree = KdTree.from_arrays(kd_tree.geometry_hash, kd_tree.to_arrays())
+                continue
+
+            # welded corners may move by up to the weld epsilon, the embedded bboxes are grown to still bound them
+            node_bbox, node_child, node_triangle = mesh.nodes
+            node_bbox = node_bbox + array(((-weld_epsilon,) * 3, (weld_epsilon,) * 3), dtype=float32)
+            mesh.kd_tree = KdTree.from_nodes(node_bbox, node_child, node_triangle, triangle_buffer)
+        return KdTree.merge([mesh.kd_tree for mesh in meshes]) if meshes else None
+
+
+@dataclass(slots=True)
+class LayerDiff:
+    hulls_added: int
+    hulls_removed: int
+    meshes_added: int
+    meshes_removed: int
+
+
+def open_parser(file_name: str) -> VphysParser | VphysBinaryParser:
+    # compiled resources (.vphys_c) are read directly, anything else as decompiled text kv3
+    if file_name.endswith("_c"): return VphysBinaryParser.from_file_name(file_name)
+    return VphysParser.from_file_name(file_name)
+
+
+def get_collision_attribute_names(parser: VphysParser | VphysBinaryParser) -> list[str]:
+    attributes = parser.search("m_collisionAttributes")
+    if not isinstance(attributes, VphysList): return list()
+
+    attribute_names = list()
+    for index, attribute in enumerate(attributes):
+        interact_as = attribute["m_InteractAsStrings"]
+        if isinstance(interact_as, VphysList | list) and len(interact_as := list(interact_as)) > 0:
+            attribute_names.append(",".join(interact_as))
+        elif isinstance(group := attribute["m_CollisionGroupString"], str) and group != "":
+            attribute_names.append(group)
+        else:
+            attribute_names.append("attribute_%i" % index)
+    return attribute_names
+
+
+def get_attribute_index(shape: VphysDict) -> int:
+    # hulls and meshes without m_nCollisionAttributeIndex belong to the default attribute 0
+    return attribute_index if isinstance(attribute_index := shape["m_nCollisionAttributeIndex"], int) else 0
+
+
+def extract_hull(hull: VphysDict) -> tuple[ndarray, tuple[ndarray, ndarray]]:
+    vertices_raw = hull.search("m_Hull", "m_Vertices")
+    planes_raw = hull.search("m_Hull", "m_Planes")
+
+    vertices = frombuffer(vertices_raw, dtype=float32).reshape((-1, 3))
+    if planes_raw is not None:
+        normals = frombuffer(planes_raw, dtype=float32).reshape((-1, 4))[:, :3]
+    else:
+        normals = hull_face_normals(vertices, hull.search("m_Hull", "m_Faces"), hull.search("m_Hull", "m_Edges"))
+
+    # offsets come from the supporting vertices, independent of the m_flOffset sign convention
+    planes = concatenate((normals, (vertices @ normals.T).max(axis=0)[:, None]), axis=1)
+    return planes, (vertices.min(axis=0), vertices.max(axis=0))
+
+
+def extract_mesh(mesh: VphysDict) -> CollisionMesh | None:
+    triangles_raw = mesh.search("m_Mesh", "m_Triangles")
+    vertices_raw = mesh.search("m_Mesh", "m_Vertices")
+    nodes_raw = mesh.search("m_Mesh", "m_Nodes")
+
+    vertices = frombuffer(vertices_raw, dtype=float32).reshape((-1, 3))
+    triangles = frombuffer(triangles_raw, dtype=int32).reshape((-1, 3))
+    if len(triangles) == 0: return None
+
+    try: nodes = decode_mesh_nodes(nodes_raw or b"", len(triangles))
+    except ValueError: nodes = None
+    return CollisionMesh(vertices, triangles, nodes)
+
+
+def weld_vertices(points: ndarray, epsilon: float, vertices_existing: ndarray | None = None) -> tuple[ndarray, ndarray]:
+    # returns (unique vertices, index of the welded vertex per point), points closer than epsilon share a vertex
+    # existing vertices keep their indices at the front of the buffer, new points weld onto them too
+    exact, inverse = unique(points, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    if vertices_existing is None and epsilon <= 0: return exact.astype(float32), inverse.astype(int32)
+
+    existing_count = 0 if vertices_existing is None else len(vertices_existing)
+    combined = exact.astype(float32) if vertices_existing is None else concatenate((vertices_existing, exact)).astype(float32)
+    epsilon_squared = max(epsilon, 0.0) ** 2
+    neighbours = WELD_NEIGHBOURS if epsilon > 0 else ((0, 0, 0),)
+    # exact welding compares the coordinate bits, + 0.0 folds -0.0 into 0.0
+    cells = floor(combined / epsilon).astype(int64) if epsilon > 0 else (combined.astype(float64) + 0.0).view(int64)
+
+    # only points sharing a cell with another point in one of 8 grids of cell size 3 epsilon, shifted by half a cell
+    # per axis, can weld, hash collisions and the coarse cells just send a few more points through the loop
+    crowded = zeros(len(combined), dtype=bool)
+    shifts = ((x, y, z) for x in (0.0, 0.5) for y in (0.0, 0.5) for z in (0.0, 0.5)) if epsilon > 0 else (None,)
+    for shift in shifts:
+        coarse = cells if shift is None else floor(combined / (3 * epsilon) + shift).astype(int64)
+        keys = (coarse[:, 0] * WELD_CELL_HASH[0]) ^ (coarse[:, 1] * WELD_CELL_HASH[1]) ^ (coarse[:, 2] * WELD_CELL_HASH[2])
+        _, key_index, key_count = unique(keys, return_inverse=True, return_counts=True)
+        crowded |= key_count[key_index] > 1
+
+    # greedy in point order like a full scan, every point welds onto the first vertex in reach
+    target = arange(len(combined))
+    grid: dict[tuple, list[tuple[int, list[float]]]] = dict()
+    crowded_index = crowded.nonzero()[0]
+    for index, point, cell in zip(crowded_index.tolist(), combined[crowded_index].tolist(), cells[crowded_index].tolist()):
+        if index >= existing_count:
+            for offset in neighbours:
+                for candidate, vertex in grid.get((cell[0] + offset[0], cell[1] + offset[1], cell[2] + offset[2]), ()):
+                    if (vertex[0] - point[0]) ** 2 + (vertex[1] - point[1]) ** 2 + (vertex[2] - point[2]) ** 2 <= epsilon_squared:
+                        target[index] = candidate
+                        break
+                if target[index] != index: break
+            if target[index] != index: continue
+        grid.setdefault(tuple(cell), []).append((index, point))
+
+    # vertices that stayed are numbered in point order after the existing ones
+    is_vertex = target == arange(len(combined))
+    vertex_index = (cumsum(is_vertex) - 1).astype(int32)
+    return combined[is_vertex], vertex_index[target[existing_count:]][inverse]
+
+
+def drop_degenerate_triangles(vertices: ndarray, indices: ndarray, epsilon: float) -> ndarray:
+    # zero area, repeated corners and slivers whose height is at most epsilon
+    points = vertices[indices].astype(float64)
+    edges = points[:, (1, 2, 0)] - points
+    double_area = norm(cross(edges[:, 0], edges[:, 1]), axis=1)
+    return indices[double_area > epsilon * norm(edges, axis=2).max(axis=1)]
+
+
+def drop_duplicate_triangles(indices: ndarray) -> ndarray:
+    # same corners in any order or winding, the first one is kept
+    _, first = unique(sort(indices, axis=1), axis=0, return_index=True)
+    return indices[sort(first)]
+
+
+def triangulate_polygon(points: ndarray, epsilon: float) -> list[tuple[int, int, int]] | None:
+    # ear clipping of a simple counter clockwise 2d polygon, positions into points, None if no ear is left
+    # corners thinner than epsilon are never clipped, and an ear is blocked by any other corner within epsilon of it
+    remaining = list(range(len(points)))
+    triangles = list()
+    while len(remaining) >= 3:
+        for position in range(len(remaining)):
+            previous, corner, following = remaining[position - 1], remaining[position], remaining[(position + 1) % len(remaining)]
+            corners = points[[previous, corner, following]]
+            edges = corners[[1, 2, 0]] - corners
+            lengths = sqrt((edges ** 2).sum(axis=1))
+            if edges[0, 0] * edges[1, 1] - edges[0, 1] * edges[1, 0] <= epsilon * lengths.max(): continue
+
+            others = points[[index for index in remaining if index not in (previous, corner, following)]]
+            # inward distance of the other corners to every edge of the ear
+            distance = (edges[:, 0] * (others[:, None, 1] - corners[:, 1]) - edges[:, 1] * (others[:, None, 0] - corners[:, 0])) / lengths
+            if (distance.min(axis=1, initial=inf) > -epsilon).any(): continue
+
+            triangles.append((previous, corner, following))
+            remaining.pop(position)
+            break
+        else: return None
+    return triangles
+
+
+def merge_coplanar_triangles(vertices: ndarray, indices: ndarray, epsilon: float) -> ndarray | None:
+    # edge connected triangles with the same facing and all corners within epsilon of one plane form a region,
+    # a region bounded by a single loop is re-triangulated from that loop when this takes fewer triangles, None if nothing merged
+    # loop corners on a straight run are left out unless a triangle outside the region uses them, so no t-junctions appear
+    a, b, c = indices.reshape(-1), indices[:, (1, 2, 0)].reshape(-1), indices[:, (2, 0, 1)].reshape(-1)
+    low, high = where(a < b, a, b), where(a < b, b, a)
+
+    # edges shared by exactly two consistently wound triangles
+    order = lexsort((high, low))
+    same = (low[order][1:] == low[order][:-1]) & (high[order][1:] == high[order][:-1])
+    single = same.copy()
+    single[1:] &= ~same[:-1]
+    single[:-1] &= ~same[1:]
+    first, second = order[:-1][single], order[1:][single]
+    consistent = (a[first] == b[second]) & (b[first] == a[second])
+    first, second = first[consistent], second[consistent]
+    if len(first) == 0: return None
+
+    points = vertices.astype(float64)
+    normals = cross(points[indices[:, 1]] - points[indices[:, 0]], points[indices[:, 2]] - points[indices[:, 0]])
+    normal = normals[first // 3]
+    coplanar = (
+        (abs(((points[c[second]] - points[a[first]]) * normal).sum(axis=1)) <= epsilon * norm(normal, axis=1)) &
+        ((normal * normals[second // 3]).sum(axis=1) > 0)
+    )
+    first, second = first[coplanar] // 3, second[coplanar] // 3
+    if len(first) == 0: return None
+
+    # connected components by label propagation with pointer jumping
+    labels = arange(len(indices))
+    while True:
+        propagated = labels.copy()
+        minimum.at(propagated, first, labels[second])
+        minimum.at(propagated, second, labels[first])
+        propagated = propagated[propagated]
+        if (propagated == labels).all(): break
+        labels = propagated
+
+    vertex_use = bincount(indices.reshape(-1), minlength=len(vertices))
+    order = argsort(labels, kind="stable")
+    region_start = concatenate(([0], (labels[order][1:] != labels[order][:-1]).nonzero()[0] + 1))
+
+    removed = zeros(len(indices), dtype=bool)
+    merged = list()
+    for region in split(order, region_start[1:]):
+        if len(region) < 2: continue
+        region_indices = indices[region]
+
+        # boundary edges are the ones whose reverse is not in the region, they have to form one simple loop
+        edges = set(zip(region_indices.reshape(-1).tolist(), region_indices[:, (1, 2, 0)].reshape(-1).tolist()))
+        if len(edges) != 3 * len(region): continue
+        following = {start: end for start, end in edges if (end, start) not in edges}
+        if len(following) != sum((end, start) not in edges for start, end in edges): continue
+        loop = [next(iter(following))]
+        while (vertex := following[loop[-1]]) != loop[0] and len(loop) <= len(following): loop.append(vertex)
+        if len(loop) != len(following): continue
+
+        # the whole region has to be flat, not just every pair of neighbours
+        region_vertices, region_use = unique(region_indices, return_counts=True)
+        plane_normal = normals[region].sum(axis=0)
+        plane_normal /= norm(plane_normal)
+        distance = points[region_vertices] @ plane_normal
+        if distance.max() - distance.min() > 2 * epsilon: continue
+
+        shared = set(region_vertices[vertex_use[region_vertices] > region_use].tolist())
+        if shared - set(loop): continue
+
+        # straight runs of the loop only keep the corners other triangles rely on
+        position = 0
+        while position < len(loop) and len(loop) > 3:
+            previous, vertex, following_vertex = points[loop[position - 1]], points[loop[position]], points[loop[(position + 1) % len(loop)]]
+            direction = following_vertex - previous
+            t = (vertex - previous) @ direction / (direction @ direction)
+            if loop[position] in shared or not 0 < t < 1 or norm(previous + t * direction - vertex) > epsilon:
+                position += 1
+                continue
+            loop.pop(position)
+            position = max(position - 1, 0)
+        if len(loop) < 3 or len(loop) - 2 >= len(region): continue
+
+        # loop in plane coordinates, counter clockwise seen from the plane normal
+        axis_u = cross(plane_normal, (1.0, 0.0, 0.0) if abs(plane_normal[0]) < 0.9 else (0.0, 1.0, 0.0))
+        axis_u /= norm(axis_u)
+        axis_v = cross(plane_normal, axis_u)
+        loop_points = points[loop]
+        if (triangles := triangulate_polygon(stack((loop_points @ axis_u, loop_points @ axis_v), axis=1), epsilon)) is None: continue
+
+        removed[region] = True
+        merged.extend(tuple(loop[corner] for corner in triangle) for triangle in triangles)
+    if not merged: return None
+
+    return concatenate((indices[~removed], array(merged, dtype=indices.dtype)))
+
+
+def simplify_triangles(vertices: ndarray, indices: ndarray, epsilon: float) -> ndarray:
+    indices = drop_duplicate_triangles(drop_degenerate_triangles(vertices, indices, epsilon))
+    while (merged := merge_coplanar_triangles(vertices, indices, epsilon)) is not None: indices = merged
+    # merging can rebuild a triangle that was already there
+    return drop_duplicate_triangles(indices)
+
+
+def index_geometry(
+        layers: dict[tuple[int, int], CollisionLayer],
+        weld_epsilon: float,
+        vertices: ndarray | None = None,
+        simplify_epsilon: float | None = None
+) -> ndarray:
+    # one vertex buffer for the whole map, every mesh gets its triangles as int32 indices into it
+    # with the buffer of a previous extraction, only meshes without indices are welded into it and unused vertices dropped
+    # with simplify_epsilon, the triangles of new meshes are simplified after welding, see simplify_triangles
+    meshes = list({id(mesh): mesh for layer in layers.values() for mesh in layer.meshes}.values())
+    if not meshes: return zeros((0, 3), dtype=float32)
+
+    patched = vertices is not None
+    if new_meshes := [mesh for mesh in meshes if mesh.indices is None]:
+        vertices, remap = weld_vertices(concatenate([mesh.vertices for mesh in new_meshes]), weld_epsilon, vertices)
+
+        vertex_offset = 0
+        for mesh in new_meshes:
+            mesh.indices = remap[vertex_offset + mesh.triangles]
+            vertex_offset += len(mesh.vertices)
+
+            if simplify_epsilon is None: continue
+            indices = simplify_triangles(vertices, mesh.indices, simplify_epsilon)
+            # the embedded hierarchy indexes the original triangles
+            if len(indices) != len(mesh.indices) or (indices != mesh.indices).any(): mesh.indices, mesh.nodes = indices, None
+    if not patched and simplify_epsilon is None: return vertices
+
+    used = zeros(len(vertices), dtype=bool)
+    for mesh in meshes: used[mesh.indices] = True
+    remap = (cumsum(used) - 1).astype(int32)
+    for mesh in meshes: mesh.indices = remap[mesh.indices]
+    return vertices[used]
+
+
+def extract_layers(
+        parser: VphysParser | VphysBinaryParser,
+        layers_previous: dict[tuple[int, int], CollisionLayer] | None = None
+) -> dict[tuple[int, int], CollisionLayer]:
+    # one walk over every part, hulls and meshes are bucketed by (part, collision attribute index)
+    # hulls and meshes whose content hash matches one of layers_previous are taken over instead of extracted again
+    attribute_names = get_collision_attribute_names(parser)
+    layers: dict[tuple[int, int], CollisionLayer] = dict()
+
+    hulls_previous: dict[bytes, tuple[ndarray, tuple[ndarray, ndarray]]] = dict()
+    meshes_previous: dict[bytes, CollisionMesh] = dict()
+    for layer in (layers_previous or dict()).values():
+        hulls_previous.update(zip(layer.hull_hashes, zip(layer.hull_planes, layer.hull_bboxes)))
+        meshes_previous.update((mesh.content_hash, mesh) for mesh in layer.meshes)
+
+    def get_layer(part: int, attribute_index: int) -> CollisionLayer:
+        if (layer := layers.get((part, attribute_index))) is None:
+            attribute_name = attribute_names[attribute_index] if attribute_index < len(attribute_names) else "attribute_%i" % attribute_index
+            layer = layers[(part, attribute_index)] = CollisionLayer(part, attribute_index, attribute_name)
+        return layer
+
+    parts = parser.search("m_parts")
+    for part_index, part in enumerate(parts if isinstance(parts, VphysList) else ()):
+        hulls = part.search("m_rnShape", "m_hulls")
+        for hull in hulls if isinstance(hulls, VphysList) else ():
+            layer = get_layer(part_index, get_attribute_index(hull))
+            content_hash = hull.get_content_hash()
+            planes, bbox = hulls_previous.get(content_hash) or extract_hull(hull)
+            layer.hull_planes.append(planes)
+            layer.hull_bboxes.append(bbox)
+            layer.hull_hashes.append(content_hash)
+
+        meshes = part.search("m_rnShape", "m_meshes")
+        for mesh in meshes if isinstance(meshes, VphysList) else ():
+            layer = get_layer(part_index, get_attribute_index(mesh))
+            content_hash = mesh.get_content_hash()
+            if (collision_mesh := meshes_previous.get(content_hash)) is None:
+                if (collision_mesh := extract_mesh(mesh)) is None: continue
+                collision_mesh.content_hash = content_hash
+            layer.meshes.append(collision_mesh)
+
+    return layers
+
+
+def get_content_hashes(parser: VphysParser | VphysBinaryParser) -> dict[tuple[int, int], tuple[list[bytes], list[bytes]]]:
+    # (hull hashes, mesh hashes) per layer, without extracting anything
+    content_hashes: dict[tuple[int, int], tuple[list[bytes], list[bytes]]] = dict()
+
+    parts = parser.search("m_parts")
+    for part_index, part in enumerate(parts if isinstance(parts, VphysList) else ()):
+        for shape_index, shape in enumerate(("m_hulls", "m_meshes")):
+            shapes = part.search("m_rnShape", shape)
+            for shape_container in shapes if isinstance(shapes, VphysList) else ():
+                key = (part_index, get_attribute_index(shape_container))
+                content_hashes.setdefault(key, (list(), list()))[shape_index].append(shape_container.get_content_hash())
+    return content_hashes
+
+
+def diff_content_hashes(
+        previous: dict[tuple[int, int], tuple[list[bytes], list[bytes]]],
+        current: dict[tuple[int, int], tuple[list[bytes], list[bytes]]]
+) -> dict[tuple[int, int], LayerDiff]:
+    # changed layers only, a modified hull or mesh counts as one removed and one added
+    layer_diffs = dict()
+    for key in sorted(previous.keys() | current.keys()):
+        hulls_previous, meshes_previous = previous.get(key, (list(), list()))
+        hulls, meshes = current.get(key, (list(), list()))
+
+        layer_diff = LayerDiff(
+            (Counter(hulls) - Counter(hulls_previous)).total(),
+            (Counter(hulls_previous) - Counter(hulls)).total(),
+            (Counter(meshes) - Counter(meshes_previous)).total(),
+            (Counter(meshes_previous) - Counter(meshes)).total(),
+        )
+        if any((layer_diff.hulls_added, layer_diff.hulls_removed, layer_diff.meshes_added, layer_diff.meshes_removed)):
+            layer_diffs.update({key: layer_diff})
+    return layer_diffs
+
+
+def write_layers(
+        file_name: str,
+        layers: dict[tuple[int, int], CollisionLayer],
+        weld_epsilon: float = WELD_EPSILON,
+        vertices: ndarray | None = None,
+        simplify_epsilon: float | None = None
+) -> None:
+    # <file_name>.geometry holds "vertices" and "indices_<part>_<attribute index>" per layer,
+    # <file_name>_<part>_<attribute index>.(kdt|hulls) the spatial indexes, names of the attributes in <file_name>_layers.pkl
+    # everything needed by update_layers is kept in <file_name>_cache.pkl
+    vertices = index_geometry(layers, weld_epsilon, vertices, simplify_epsilon)
+
+    geometry = dict(vertices=vertices)
+    index_file_names = set()
+    for (part, attribute_index), layer in layers.items():
+        layer_file_name = "%s_%i_%i" % (file_name, part, attribute_index)
+        geometry.update({"indices_%i_%i" % (part, attribute_index): layer.get_indices()})
+
+        layer.get_convex_hulls(simplify_epsilon is not None).save(f"{layer_file_name}.hulls")
+        index_file_names.add(basename(f"{layer_file_name}.hulls"))
+        if (kd_tree := layer.get_kd_tree(vertices, weld_epsilon)) is not None:
+            kd_tree.save(f"{layer_file_name}.kdt")
+            index_file_names.add(basename(f"{layer_file_name}.kdt"))
+
+    # indexes of layers that are gone or lost all their meshes would otherwise still be loaded next to the new geometry
+    directory = dirname(file_name)
+    for entry in listdir(directory or "."):
+        if fullmatch(r"%s_\d+_\d+\.(kdt|hulls)" % escape(basename(file_name)), entry) and entry not in index_file_names:
+            remove(join(directory, entry))
+
+    write_index_file(
+        f"{file_name}.geometry",
+        sha256(b"".join(value.tobytes() for value in geometry.values())).digest(),
+        geometry
+    )
+    with open(f"{file_name}_layers.pkl", "wb") as file:
+        dump({key: layer.attribute_name for key, layer in layers.items()}, file, protocol=HIGHEST_PROTOCOL)
+    with open(f"{file_name}_cache.pkl", "wb") as file:
+        dump(((weld_epsilon, simplify_epsilon), vertices, [layer.to_cache() for layer in layers.values()]), file, protocol=HIGHEST_PROTOCOL)
+
+
+def update_layers(
+        file_name: str,
+        parser: VphysParser | VphysBinaryParser,
+        weld_epsilon: float = WELD_EPSILON,
+        simplify_epsilon: float | None = None
+) -> dict[tuple[int, int], LayerDiff]:
+    # re-extracts only what changed since the last write_layers into file_name, falls back to a full extraction without a cache
+    # or when it was written with other settings, hashes of the text and the binary parser differ, switching re-extracts everything
+    # an unreadable cache (stale format, truncated, corrupt) also means a full extraction
+    layers_previous, vertices = None, None
+    if exists(f"{file_name}_cache.pkl"):
+        try:
+            with open(f"{file_name}_cache.pkl", "rb") as file:
+                cache_settings, cache_vertices, cache_layers = load(file)
+            cache_layers = [CollisionLayer.from_cache(layer) for layer in cache_layers]
+        except (AttributeError, EOFError, ImportError, IndexError, TypeError, UnpicklingError, ValueError):
+            cache_settings = None
+        if cache_settings == (weld_epsilon, simplify_epsilon):
+            layers_previous, vertices = {(layer.part, layer.attribute_index): layer for layer in cache_layers}, cache_vertices
+
+    layers = extract_layers(parser, layers_previous)
+    write_layers(file_name, layers, weld_epsilon, vertices, simplify_epsilon)
+    return diff_content_hashes(
+        {key: layer.get_content_hashes() for key, layer in (layers_previous or dict()).items()},
+        {key: layer.get_content_hashes() for key, layer in layers.items()}
+    )
 
 
 def main() -> None:
-    parser = VphysParser.from_file_name("parse_example.vphys")
-    saved_triangles = list()
-
-    index = 0
-    while True:
-        collision = parser.search("m_parts", 0, "m_rnShape", "m_hulls", index, "m_nCollisionAttributeIndex")
-        if collision is None: break
-        if collision != 0:
-            index += 1
-            continue
-
-        vertices_raw = parser.search("m_parts", 0, "m_rnShape", "m_hulls", index, "m_Hull", "m_Vertices")
-        faces_raw = parser.search("m_parts", 0, "m_rnShape", "m_hulls", index, "m_Hull", "m_Faces")
-        edges_raw = parser.search("m_parts", 0, "m_rnShape", "m_hulls", index, "m_Hull", "m_Edges")
-
-        vertices = list()
-        vertices_merged = BytesFactory.bytes_merge(vertices_raw, 4)
-        for i in range(len(vertices_merged) // 3):
-            i *= 3
-            vertices.append(Vec3(
-                BytesFactory.float(vertices_merged[i]),
-                BytesFactory.float(vertices_merged[i + 1]),
-                BytesFactory.float(vertices_merged[i + 2])
-            ))
-
-        faces = [
-            BytesFactory.uint8(byte)
-            for byte in BytesFactory.bytes_merge(faces_raw, 1)
-        ]
-
-        edges = list()
-        edges_merged = BytesFactory.bytes_merge(edges_raw, 1)
-        for i in range(len(edges_merged) // 4):
-            i *= 4
-            edges.append(Edge(
-                BytesFactory.uint8(edges_merged[i]),
-                BytesFactory.uint8(edges_merged[i + 1]),
-                BytesFactory.uint8(edges_merged[i + 2]),
-                BytesFactory.uint8(edges_merged[i + 3])
-            ))
-
-        for start_edge in faces:
-            edge = edges[start_edge].next
-            while edge != start_edge:
-                next_edge = edges[edge].next
-
-                saved_triangles.append(Triangle(
-                    vertices[edges[start_edge].origin],
-                    vertices[edges[edge].origin],
-                    vertices[edges[next_edge].origin],
-                ))
-
-                edge = next_edge
-        index += 1
-
-    index = 0
-    while True:
-        collision = parser.search("m_parts", 0, "m_rnShape", "m_meshes", index, "m_nCollisionAttributeIndex")
-        if collision is None: break
-        if collision != 0:
-            index += 1
-            continue
-
-        triangles_raw = parser.search("m_parts", 0, "m_rnShape", "m_meshes", index, "m_Mesh", "m_Triangles")
-        vertices_raw = parser.search("m_parts", 0, "m_rnShape", "m_meshes", index, "m_Mesh", "m_Vertices")
-
-        vertices = list()
-        vertices_merged = BytesFactory.bytes_merge(vertices_raw, 4)
-        for i in range(len(vertices_merged) // 3):
-            i *= 3
-            vertices.append(Vec3(
-                BytesFactory.float(vertices_merged[i]),
-                BytesFactory.float(vertices_merged[i + 1]),
-                BytesFactory.float(vertices_merged[i + 2])
-            ))
-
-        triangles_merged = [
-            BytesFactory.int32(byte)
-            for byte in BytesFactory.bytes_merge(triangles_raw, 4)
-        ]
-        for i in range(len(triangles_merged) // 3):
-            i *= 3
-            saved_triangles.append(Triangle(
-                vertices[triangles_merged[i]],
-                vertices[triangles_merged[i + 1]],
-                vertices[triangles_merged[i + 2]],
-            ))
-        index += 1
-
-    write_pkl("output", saved_triangles)
-    write_tri("output", saved_triangles)
+    argument_parser = ArgumentParser(description="Extracts collision layers and their spatial indexes from a vphys file.")
+    argument_parser.add_argument(
+        "file_name", nargs="?",
+        default="parse_example.vphys_c" if exists("parse_example.vphys_c") else "parse_example.vphys"
+    )
+    argument_parser.add_argument("--output", default="output")
+    argument_parser.add_argument("--diff", metavar="PREVIOUS_FILE_NAME", help="only list the layers changed since this version")
+    argument_parser.add_argument(
+        "--simplify", type=float, nargs="?", const=SIMPLIFY_EPSILON, default=None, metavar="EPSILON",
+        help="drop degenerate and duplicate triangles and merge coplanar ones before indexing"
+    )
+    arguments = argument_parser.parse_args()
+
+    parser = open_parser(arguments.file_name)
+    if arguments.diff is not None:
+        layer_diffs = diff_content_hashes(get_content_hashes(open_parser(arguments.diff)), get_content_hashes(parser))
+    else:
+        layer_diffs = update_layers(arguments.output, parser, simplify_epsilon=arguments.simplify)
+
+    for (part, attribute_index), layer_diff in layer_diffs.items():
+        print("%i_%i: hulls +%i -%i, meshes +%i -%i" % (
+            part, attribute_index,
+            layer_diff.hulls_added, layer_diff.hulls_removed, layer_diff.meshes_added, layer_diff.meshes_removed
+        ))
 
 
 
@@ -0,0 +1,396 @@
+from functools import cache
+from hashlib import sha256
+from itertools import combinations
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Final
+
+from numpy import (
+    arange, array, concatenate, cross, cumsum, empty, errstate, eye, float32, float64, inf, int32, lexsort, maximum, minimum, ndarray, ones,
+    repeat, searchsorted, split, stack, unique, where, zeros
+)
+from numpy.linalg import norm
+
+from .index_file import attach_index_shared_memory, create_index_shared_memory, read_index_file, write_index_file
+from .kd_tree import build_box_hierarchy
+from .math_helper import HitMode, Vec3, segments_boxes_intersect
+
+
+# most (segment, hull) pairs clipped at once, bounds the pairs x planes temporaries
+HULL_PAIR_CHUNK: Final[int] = 1 << 16
+# relative tolerance when building hull vertices and edges from the planes
+HULL_VERTEX_EPSILON: Final[float] = 1e-5
+
+
+def in_chunks(count: int, function: Callable[[slice], tuple[ndarray, ...]], chunk: int = HULL_PAIR_CHUNK) -> tuple[ndarray, ...]:
+    results = [function(slice(start, start + chunk)) for start in range(0, count, chunk)]
+    return tuple(concatenate(parts) for parts in zip(*results))
+
+
+def pair_items(item_range: ndarray, hulls: ndarray) -> tuple[ndarray, ndarray, ndarray]:
+    # items (planes, edges) of every pair laid out back to back, as (pair per item, item index, first item per pair)
+    # item_range: (start, count) per hull, every hull in hulls needs at least one item
+    item_count = item_range[hulls, 1]
+    pair_start = zeros(len(hulls), dtype=int32)
+    pair_start[1:] = cumsum(item_count)[:-1]
+
+    pair = repeat(arange(len(hulls)), item_count)
+    return pair, item_range[hulls, 0][pair] + arange(len(pair)) - pair_start[pair], pair_start
+
+
+@cache
+def plane_triples(count: int) -> ndarray:
+    return array(tuple(combinations(range(count), 3)), dtype=int32).reshape((-1, 3))
+
+
+def build_hull_features(planes: ndarray, hull_plane: ndarray) -> tuple[ndarray, ndarray, ndarray, ndarray]:
+    # per hull the edges as (k, 2, 3) segments and the bevel planes (hull edge x world axis and the world axes themselves
+    # at the tight vertex extents), which with the hull planes complete the separating axis test against boxes
+    # vertices come from every triple of planes whose intersection lies inside the others, unbounded hulls get neither
+    edges: list[ndarray] = list()
+    hull_edge = zeros((len(hull_plane), 2), dtype=int32)
+    bevel_planes: list[ndarray] = list()
+    hull_bevel_plane = zeros((len(hull_plane), 2), dtype=int32)
+    edge_count = bevel_count = 0
+
+    for hull, (start, count) in enumerate(hull_plane.tolist()):
+        normals, offsets = planes[start:start + count, :3].astype(float64), planes[start:start + count, 3].astype(float64)
+        lengths = norm(normals, axis=1)
+        tolerance = HULL_VERTEX_EPSILON * max(1.0, (abs(offsets) / lengths).max(initial=0.0))
+
+        # cramer's rule on every triple (i, j, k): the determinant is n_i . (n_j x n_k)
+        i, j, k = plane_triples(count).T
+        jk, ki, ij = cross(normals[j], normals[k]), cross(normals[k], normals[i]), cross(normals[i], normals[j])
+        determinant = (normals[i] * jk).sum(axis=1)
+        solvable = abs(determinant) > HULL_VERTEX_EPSILON * lengths[i] * lengths[j] * lengths[k]
+        vertices = (
+            (offsets[i, None] * jk + offsets[j, None] * ki + offsets[k, None] * ij)[solvable] / determinant[solvable, None]
+        )
+        vertices = vertices[(vertices @ normals.T - offsets <= tolerance * lengths).all(axis=1)]
+        if len(vertices) < 4: continue
+        # a direction no plane bounds makes the hull unbounded, if there is one it lies along the cross product of two normals
+        rays = ij[norm(ij, axis=1) > 0]
+        rays = rays / norm(rays, axis=1)[:, None]
+        rays = concatenate((rays, -rays))
+        if ((rays @ normals.T) <= HULL_VERTEX_EPSILON * lengths).all(axis=1).any(): continue
+
+        # an edge is where two planes share at least two vertices, its ends are the outermost of them
+        on_plane = abs(vertices @ normals.T - offsets) <= tolerance * lengths
+        first, second = ((on_plane.T.astype(int32) @ on_plane.astype(int32)) >= 2).nonzero()
+        first, second = first[first < second], second[first < second]
+        directions = cross(normals[first], normals[second])
+        shared = on_plane[:, first] & on_plane[:, second]
+        along = vertices @ directions.T
+        ends = stack((where(shared, along, inf).argmin(axis=0), where(shared, along, -inf).argmax(axis=0)), axis=1)
+        hull_edges = vertices[ends]
+        hull_edges = hull_edges[norm(hull_edges[:, 1] - hull_edges[:, 0], axis=1) > tolerance]
+
+        edge_directions = hull_edges[:, 1] - hull_edges[:, 0]
+        axes = cross(edge_directions[:, None], eye(3)[None]).reshape((-1, 3))
+        axes = axes[norm(axes, axis=1) > HULL_VERTEX_EPSILON * norm(edge_directions, axis=1).repeat(3)]
+        axes = unique((concatenate((eye(3), axes / norm(axes, axis=1)[:, None])) * 1e6).round() / 1e6, axis=0)
+        axes = concatenate((axes, -axes))
+        # padded by the tolerance so the float32 offsets never cut into the hull
+        hull_bevel_planes = concatenate((axes, (vertices @ axes.T).max(axis=0)[:, None] + tolerance), axis=1)
+
+        edges.append(hull_edges)
+        hull_edge[hull] = (edge_count, len(hull_edges))
+        edge_count += len(hull_edges)
+        bevel_planes.append(hull_bevel_planes)
+        hull_bevel_plane[hull] = (bevel_count, len(hull_bevel_planes))
+        bevel_count += len(hull_bevel_planes)
+
+    return (
+        concatenate(edges).astype(float32) if edges else zeros((0, 2, 3), dtype=float32), hull_edge,
+        concatenate(bevel_planes).astype(float32) if bevel_planes else zeros((0, 4), dtype=float32), hull_bevel_plane
+    )
+
+
+class ConvexHulls:
+    def __init__(
+            self, planes: ndarray, hull_plane: ndarray, hull_bbox: ndarray,
+            hierarchy: tuple[ndarray, ndarray, ndarray, ndarray] | None = None,
+            features: tuple[ndarray, ndarray, ndarray, ndarray] | None = None
+    ) -> None:
+        # planes: (normal, offset), a point is inside a hull when normal . point <= offset for all of its planes
+        self.planes = planes.astype(float32, copy=False)
+        # hull i: planes (start, count), bbox (min, max)
+        self.hull_plane = hull_plane.astype(int32, copy=False)
+        self.hull_bbox = hull_bbox.astype(float32, copy=False)
+        # aabb hierarchy over the hulls, node i: bbox, children, hulls (start, count) into hull_index, see build_box_hierarchy
+        self.node_bbox, self.node_child, self.node_hull, self.hull_index = (
+            hierarchy if hierarchy is not None else build_box_hierarchy(self.hull_bbox)
+        )
+        # hull i: edges (start, count) as segments, bevel planes (start, count), see build_hull_features
+        self.edges, self.hull_edge, self.bevel_planes, self.hull_bevel_plane = (
+            features if features is not None else build_hull_features(self.planes, self.hull_plane)
+        )
+
+        self.geometry_hash = sha256(self.planes.tobytes() + self.hull_plane.tobytes()).digest()
+        self.shared_memory: SharedMemory | None = None
+
+    def __len__(self) -> int:
+        return len(self.hull_plane)
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, ndarray]) -> "ConvexHulls":
+        # files written before the hierarchy or the edges were stored get them built on load
+        hierarchy = tuple(arrays[name] for name in ("node_bbox", "node_child", "node_hull", "hull_index")) if "node_bbox" in arrays else None
+        features = tuple(arrays[name] for name in ("edges", "hull_edge", "bevel_planes", "hull_bevel_plane")) if "edges" in arrays else None
+        return cls(arrays["planes"], arrays["hull_plane"], arrays["hull_bbox"], hierarchy, features)
+
+    def to_arrays(self) -> dict[str, ndarray]:
+        return dict(
+            planes=self.planes,
+            hull_plane=self.hull_plane,
+            hull_bbox=self.hull_bbox,
+            node_bbox=self.node_bbox,
+            node_child=self.node_child,
+            node_hull=self.node_hull,
+            hull_index=self.hull_index,
+            edges=self.edges,
+            hull_edge=self.hull_edge,
+            bevel_planes=self.bevel_planes,
+            hull_bevel_plane=self.hull_bevel_plane,
+        )
+
+    @classmethod
+    def load(cls, file_name: str) -> "ConvexHulls":
+        _, arrays = read_index_file(file_name)
+        return cls.from_arrays(arrays)
+
+    def save(self, file_name: str) -> None:
+        write_index_file(file_name, self.geometry_hash, self.to_arrays())
+
+    @classmethod
+    def from_shared_memory(cls, name: str) -> "ConvexHulls":
+        shared_memory, _, arrays = attach_index_shared_memory(name)
+
+        convex_hulls = cls.from_arrays(arrays)
+        convex_hulls.shared_memory = shared_memory
+        return convex_hulls
+
+    def to_shared_memory(self, name: str) -> SharedMemory:
+        return create_index_shared_memory(name, self.geometry_hash, self.to_arrays())
+
+    def segments_hull_candidates(self, origins: ndarray, directions: ndarray) -> tuple[ndarray, ndarray]:
+        # segment / hull aabb pairs that overlap, as (segment index, hull index) ordered by segment then hull
+        segment_pairs, hull_pairs = [empty(0, dtype=int32)], [empty(0, dtype=int32)]
+
+        stack = [(0, arange(len(origins), dtype=int32))] if len(self.node_bbox) > 0 else []
+        while stack:
+            node, segments = stack.pop()
+            bbox = self.node_bbox[node]
+            segments = segments[segments_boxes_intersect(origins[segments], directions[segments], bbox[0], bbox[1])]
+            if len(segments) == 0: continue
+
+            hull_start, hull_count = self.node_hull[node]
+            if hull_count > 0:
+                hulls = self.hull_index[hull_start:hull_start + hull_count]
+                segment_index, hull_offset = segments_boxes_intersect(
+                    origins[segments, None], directions[segments, None], self.hull_bbox[None, hulls, 0], self.hull_bbox[None, hulls, 1]
+                ).nonzero()
+                segment_pairs.append(segments[segment_index])
+                hull_pairs.append(hulls[hull_offset])
+                continue
+
+            left, right = self.node_child[node]
+            if right >= 0: stack.append((right, segments))
+            if left >= 0: stack.append((left, segments))
+
+        segments, hulls = concatenate(segment_pairs), concatenate(hull_pairs)
+        order = lexsort((hulls, segments))
+        return segments[order], hulls[order]
+
+    def pair_planes(self, hulls: ndarray) -> tuple[ndarray, ndarray, ndarray]:
+        # planes of every pair laid out back to back, as (pair per plane, planes, first plane per pair)
+        pair, plane_index, pair_start = pair_items(self.hull_plane, hulls)
+        return pair, self.planes[plane_index].astype(float64), pair_start
+
+    def segments_clip(self, origins: ndarray, directions: ndarray, segments: ndarray, hulls: ndarray) -> tuple[ndarray, ndarray]:
+        # clips every (segment, hull) pair against the hull planes, returns (t_enter, t_exit) per pair
+        pair, planes, pair_start = self.pair_planes(hulls)
+
+        denominator = (planes[:, :3] * directions[segments][pair]).sum(axis=1)
+        distance = planes[:, 3] - (planes[:, :3] * origins[segments][pair]).sum(axis=1)
+
+        with errstate(divide="ignore", invalid="ignore"):
+            t = distance / denominator
+        # parallel planes either reject the whole segment or do not constrain it
+        t_enter = where(denominator < 0, t, where((denominator == 0) & (distance < 0), inf, -inf))
+        t_exit = where(denominator > 0, t, where((denominator == 0) & (distance < 0), -inf, inf))
+
+        return (
+            maximum(maximum.reduceat(t_enter, pair_start), 0.0),
+            minimum(minimum.reduceat(t_exit, pair_start), 1.0)
+        )
+
+    def segments_intersect(self, origins: ndarray, ends: ndarray, mode: HitMode = HitMode.ANY) -> ndarray:
+        # returns the lowest (any) or nearest (closest) hull hit per segment, -1 if none
+        if mode == HitMode.ALL: raise ValueError("All hits do not fit one hull per segment, use segments_hits.")
+
+        hits = zeros(len(origins), dtype=int32) - 1
+        segments, hulls, _, _ = self.segments_hits(origins, ends, mode)
+        hits[segments] = hulls
+        return hits
+
+    def segments_hits(self, origins: ndarray, ends: ndarray, mode: HitMode = HitMode.ANY) -> tuple[ndarray, ndarray, ndarray, ndarray]:
+        # hits as (segment index, hull index, t_enter, t_exit), ordered by segment then hull index for any, t_enter otherwise
+        # any and closest keep at most one hit per segment
+        EPSILON = 1e-6
+
+        origins = origins.astype(float64, copy=False)
+        directions = ends - origins
+        no_hits = empty(0, dtype=int32), empty(0, dtype=int32), empty(0, dtype=float64), empty(0, dtype=float64)
+        if len(self) == 0: return no_hits
+
+        segments, hulls = self.segments_hull_candidates(origins, directions)
+        if len(segments) == 0: return no_hits
+
+        t_enter, t_exit = in_chunks(len(segments), lambda chunk: self.segments_clip(origins, directions, segments[chunk], hulls[chunk]))
+        is_hit = t_enter + EPSILON < t_exit
+        segments, hulls, t_enter, t_exit = segments[is_hit].astype(int32), hulls[is_hit].astype(int32), t_enter[is_hit], t_exit[is_hit]
+
+        # candidates come ordered by segment then hull
+        if mode != HitMode.ANY:
+            order = lexsort((t_enter, segments))
+            segments, hulls, t_enter, t_exit = segments[order], hulls[order], t_enter[order], t_exit[order]
+        if mode == HitMode.ALL: return segments, hulls, t_enter, t_exit
+
+        first = ones(len(segments), dtype=bool)
+        first[1:] = segments[1:] != segments[:-1]
+        return segments[first], hulls[first], t_enter[first], t_exit[first]
+
+    def volumes_hull_candidates(self, boxes_min: ndarray, boxes_max: ndarray) -> tuple[ndarray, ndarray]:
+        # query box / hull aabb pairs that overlap, as (query index, hull index) ordered by query then hull
+        query_pairs, hull_pairs = [empty(0, dtype=int32)], [empty(0, dtype=int32)]
+
+        stack = [(0, arange(len(boxes_min), dtype=int32))] if len(self.node_bbox) > 0 else []
+        while stack:
+            node, queries = stack.pop()
+            bbox = self.node_bbox[node]
+            queries = queries[((boxes_min[queries] <= bbox[1]) & (boxes_max[queries] >= bbox[0])).all(axis=1)]
+            if len(queries) == 0: continue
+
+            hull_start, hull_count = self.node_hull[node]
+            if hull_count > 0:
+                hulls = self.hull_index[hull_start:hull_start + hull_count]
+                query_index, hull_offset = (
+                    (boxes_min[queries, None] <= self.hull_bbox[None, hulls, 1]) & (boxes_max[queries, None] >= self.hull_bbox[None, hulls, 0])
+                ).all(axis=-1).nonzero()
+                query_pairs.append(queries[query_index])
+                hull_pairs.append(hulls[hull_offset])
+                continue
+
+            left, right = self.node_child[node]
+            if right >= 0: stack.append((right, queries))
+            if left >= 0: stack.append((left, queries))
+
+        queries, hulls = concatenate(query_pairs), concatenate(hull_pairs)
+        order = lexsort((hulls, queries))
+        return queries[order], hulls[order]
+
+    def planes_outside(self, plane_range: ndarray, planes: ndarray, centers: ndarray, half_extents: ndarray, hulls: ndarray) -> ndarray:
+        # per (box, hull) pair whether the box lies fully outside one of the given planes of the hull
+        pair, plane_index, pair_start = pair_items(plane_range, hulls)
+        pair_planes = planes[plane_index].astype(float64)
+        normals = pair_planes[:, :3]
+        return maximum.reduceat(
+            (normals * centers[pair]).sum(axis=1) - (abs(normals) * half_extents[pair]).sum(axis=1) > pair_planes[:, 3], pair_start
+        )
+
+    def boxes_overlap(self, centers: ndarray, half_extents: ndarray, hulls: ndarray) -> tuple[ndarray]:
+        # separating axis test, one (center, half extent) per hull: hull planes, then the bevel planes for the other axes
+        overlaps = ~self.planes_outside(self.hull_plane, self.planes, centers, half_extents, hulls)
+        if len(bevelled := (overlaps & (self.hull_bevel_plane[hulls, 1] > 0)).nonzero()[0]):
+            overlaps[bevelled] = ~self.planes_outside(
+                self.hull_bevel_plane, self.bevel_planes, centers[bevelled], half_extents[bevelled], hulls[bevelled]
+            )
+        return overlaps,
+
+    def spheres_overlap(self, centers: ndarray, radii: ndarray, hulls: ndarray) -> tuple[ndarray]:
+        # one (center, radius) per hull, the distance to a hull is the one to its farthest plane when the center projects
+        # onto that face, otherwise the one to its nearest edge, hulls without edges only get the plane test
+        pair, planes, pair_start = self.pair_planes(hulls)
+        lengths = norm(planes[:, :3], axis=1)
+        distance = ((planes[:, :3] * centers[pair]).sum(axis=1) - planes[:, 3]) / lengths
+        face_distance = maximum.reduceat(distance, pair_start)
+
+        face = minimum.reduceat(where(distance == face_distance[pair], arange(len(pair)), len(pair)), pair_start)
+        projected = centers - face_distance[:, None] * planes[face, :3] / lengths[face, None]
+        off_face = maximum.reduceat(
+            ((planes[:, :3] * projected[pair]).sum(axis=1) > planes[:, 3]) & (arange(len(pair)) != face[pair]), pair_start
+        )
+        overlaps = (face_distance <= 0) | (face_distance <= radii) & (~off_face | (self.hull_edge[hulls, 1] == 0))
+
+        if len(rest := ((face_distance > 0) & (face_distance <= radii) & off_face & (self.hull_edge[hulls, 1] > 0)).nonzero()[0]):
+            edge_pair, edge_index, edge_start = pair_items(self.hull_edge, hulls[rest])
+            start, direction = self.edges[edge_index, 0].astype(float64), (self.edges[edge_index, 1] - self.edges[edge_index, 0]).astype(float64)
+            offset = centers[rest][edge_pair] - start
+            t = (offset * direction).sum(axis=1) / (direction ** 2).sum(axis=1)
+            edge_distance = norm(offset - minimum(maximum(t, 0.0), 1.0)[:, None] * direction, axis=1)
+            overlaps[rest] = minimum.reduceat(edge_distance, edge_start) <= radii[rest]
+        return overlaps,
+
+    def volumes_query(
+            self, boxes_min: ndarray, boxes_max: ndarray, overlap: Callable[[ndarray, ndarray], tuple[ndarray]], chunk: int = HULL_PAIR_CHUNK
+    ) -> tuple[ndarray, ndarray]:
+        # candidates from the hierarchy confirmed by overlap(query indices, hulls) -> (mask,), as (query index, hull index)
+        # ordered by query then hull
+        queries, hulls = self.volumes_hull_candidates(boxes_min, boxes_max)
+        if len(queries) == 0: return queries, hulls
+
+        overlaps, = in_chunks(len(queries), lambda pairs: overlap(queries[pairs], hulls[pairs]), chunk)
+        return queries[overlaps], hulls[overlaps]
+
+    def boxes_query(self, boxes_min: ndarray, boxes_max: ndarray) -> list[ndarray]:
+        # hulls overlapping each box (m, 3), ascending
+        boxes_min = boxes_min.astype(float64, copy=False)
+        boxes_max = boxes_max.astype(float64, copy=False)
+        centers, half_extents = (boxes_min + boxes_max) / 2, (boxes_max - boxes_min) / 2
+
+        queries, hulls = self.volumes_query(
+            boxes_min, boxes_max, lambda queries, hulls: self.boxes_overlap(centers[queries], half_extents[queries], hulls),
+            # hulls carry several bevel planes per edge
+            HULL_PAIR_CHUNK >> 4
+        )
+        return split(hulls, searchsorted(queries, arange(1, len(boxes_min))))
+
+    def box_query(self, box_min: Vec3, box_max: Vec3) -> ndarray:
+        return self.boxes_query(array((tuple(box_min),), dtype=float64), array((tuple(box_max),), dtype=float64))[0]
+
+    def spheres_query(self, centers: ndarray, radii: ndarray) -> list[ndarray]:
+        # hulls overlapping each sphere, centers (m, 3), radii (m,), ascending
+        centers = centers.astype(float64, copy=False)
+        radii = radii.astype(float64, copy=False)
+
+        queries, hulls = self.volumes_query(
+            centers - radii[:, None], centers + radii[:, None],
+            lambda queries, hulls: self.spheres_overlap(centers[queries], radii[queries], hulls)
+        )
+        return split(hulls, searchsorted(queries, arange(1, len(centers))))
+
+    def sphere_query(self, center: Vec3, radius: float) -> ndarray:
+        return self.spheres_query(array((tuple(center),), dtype=float64), array((radius,), dtype=float64))[0]
+
+    def points_inside(self, points: ndarray) -> ndarray:
+        # returns the first hull containing each point, -1 if none
+        points = points.astype(float64, copy=False)
+        inside = zeros(len(points), dtype=int32) - 1
+
+        points_index, hulls = self.volumes_query(
+            points, points, lambda queries, hulls: (~self.planes_outside(self.hull_plane, self.planes, points[queries], zeros((len(queries), 3)), hulls),)
+        )
+        inside[points_index[::-1]] = hulls[::-1]
+        return inside
+
+    def point_inside(self, point: Vec3) -> int | None:
+        hull = self.points_inside(array((tuple(point),), dtype=float64))[0]
+        return int(hull) if hull >= 0 else None
+
+    def ray_intersects_hulls(self, ray_origin: Vec3, ray_end: Vec3, mode: HitMode = HitMode.ANY) -> int | None:
+        hull = self.segments_intersect(
+            array((tuple(ray_origin),), dtype=float64),
+            array((tuple(ray_end),), dtype=float64),
+            mode
+        )[0]
+        return int(hull) if hull >= 0 else None
@@ -0,0 +1,116 @@
+from mmap import mmap, ACCESS_READ
+from multiprocessing.shared_memory import SharedMemory
+from struct import calcsize, pack_into, unpack_from
+from typing import Final
+
+from numpy import ascontiguousarray, dtype, frombuffer, ndarray, prod
+
+
+INDEX_FILE_MAGIC: Final[bytes] = b"VPIX"
+INDEX_FILE_VERSION: Final[int] = 1
+INDEX_FILE_ALIGNMENT: Final[int] = 64
+
+# magic, version, array count, source geometry hash (sha256)
+INDEX_FILE_HEADER: Final[str] = "<4sHH32s"
+# name, dtype, ndim, shape, offset, byte size
+INDEX_FILE_ENTRY: Final[str] = "<16s4sI3IQQ"
+INDEX_FILE_NAME_SIZE: Final[int] = 16
+
+
+def align(offset: int) -> int:
+    return (offset + INDEX_FILE_ALIGNMENT - 1) // INDEX_FILE_ALIGNMENT * INDEX_FILE_ALIGNMENT
+
+
+def index_buffer_layout(arrays: dict[str, ndarray]) -> tuple[int, dict[str, int]]:
+    offset = calcsize(INDEX_FILE_HEADER) + calcsize(INDEX_FILE_ENTRY) * len(arrays)
+
+    offsets = dict()
+    for name, value in arrays.items():
+        if value.ndim > 3: raise ValueError("Array %s has more than 3 dimensions." % name)
+        # struct would silently truncate it, and truncated names can collide on read
+        if len(name.encode()) > INDEX_FILE_NAME_SIZE: raise ValueError("Array name %s is longer than %i bytes." % (name, INDEX_FILE_NAME_SIZE))
+        offset = align(offset)
+        offsets.update({name: offset})
+        offset += value.nbytes
+    return offset, offsets
+
+
+def write_index_buffer(buffer: memoryview | bytearray, geometry_hash: bytes, arrays: dict[str, ndarray]) -> None:
+    _, offsets = index_buffer_layout(arrays)
+
+    pack_into(INDEX_FILE_HEADER, buffer, 0, INDEX_FILE_MAGIC, INDEX_FILE_VERSION, len(arrays), geometry_hash)
+    entry_offset = calcsize(INDEX_FILE_HEADER)
+    for name, value in arrays.items():
+        value = ascontiguousarray(value)
+        shape = tuple(value.shape) + (0,) * (3 - value.ndim)
+
+        pack_into(
+            INDEX_FILE_ENTRY, buffer, entry_offset,
+            name.encode(), value.dtype.str.encode(), value.ndim, *shape, offsets[name], value.nbytes
+        )
+        entry_offset += calcsize(INDEX_FILE_ENTRY)
+
+        buffer[offsets[name]:offsets[name] + value.nbytes] = value.tobytes()
+
+
+def read_index_buffer(buffer: memoryview | bytes | mmap) -> tuple[bytes, dict[str, ndarray]]:
+    magic, version, array_count, geometry_hash = unpack_from(INDEX_FILE_HEADER, buffer, 0)
+    if magic != INDEX_FILE_MAGIC: raise ValueError("Not an index file.")
+    if version != INDEX_FILE_VERSION: raise ValueError("Index file version %i is not supported." % version)
+
+    arrays = dict()
+    entry_offset = calcsize(INDEX_FILE_HEADER)
+    for _ in range(array_count):
+        name, dtype_str, ndim, *shape_offset = unpack_from(INDEX_FILE_ENTRY, buffer, entry_offset)
+        shape, offset, nbytes = tuple(shape_offset[:ndim]), shape_offset[3], shape_offset[4]
+        entry_offset += calcsize(INDEX_FILE_ENTRY)
+
+        array_dtype = dtype(dtype_str.rstrip(b"\x00").decode())
+        if array_dtype.itemsize * int(prod(shape)) != nbytes: raise ValueError("Array %s is truncated." % name)
+
+        arrays.update({
+            name.rstrip(b"\x00").decode(): frombuffer(buffer, array_dtype, int(prod(shape)), offset).reshape(shape)
+        })
+    return geometry_hash, arrays
+
+
+def write_index_file(file_name: str, geometry_hash: bytes, arrays: dict[str, ndarray]) -> None:
+    size, _ = index_buffer_layout(arrays)
+    buffer = bytearray(size)
+    write_index_buffer(buffer, geometry_hash, arrays)
+
+    with open(file_name, "wb") as file:
+        file.write(buffer)
+
+
+def read_index_file(file_name: str) -> tuple[bytes, dict[str, ndarray]]:
+    # arrays keep the mapping alive, pages are shared through the os page cache between processes
+    with open(file_name, "rb") as file:
+        mapping = mmap(file.fileno(), 0, access=ACCESS_READ)
+    return read_index_buffer(mapping)
+
+
+class IndexSharedMemory(SharedMemory):
+    # arrays handed out still export the mapping when this is collected, it is then unmapped with the last of them
+    def __del__(self) -> None:
+        try: self.close()
+        except BufferError: pass
+
+
+def create_index_shared_memory(name: str, geometry_hash: bytes, arrays: dict[str, ndarray]) -> SharedMemory:
+    # the creating process owns the block: keep it referenced while workers run, then close() and unlink()
+    size, _ = index_buffer_layout(arrays)
+    shared_memory = SharedMemory(name, create=True, size=size)
+    write_index_buffer(shared_memory.buf, geometry_hash, arrays)
+    return shared_memory
+
+
+def attach_index_shared_memory(name: str) -> tuple[SharedMemory, bytes, dict[str, ndarray]]:
+    # arrays are read-only views into the block, the returned SharedMemory must outlive them
+    # before python 3.13 attaching registers the block with the resource tracker as well,
+    # harmless for workers started by the creating process since they share its tracker
+    try: shared_memory = IndexSharedMemory(name, track=False)
+    except TypeError: shared_memory = IndexSharedMemory(name)
+
+    geometry_hash, arrays = read_index_buffer(shared_memory.buf.toreadonly())
+    return shared_memory, geometry_hash, arrays
@@ -1,13 +1,29 @@
 from copy import copy
 from dataclasses import dataclass
 from functools import cmp_to_key
+from hashlib import sha256
 from heapq import nlargest
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Final
 
-from .math_helper import Triangle, BoundingBox, Vec3
+from numpy import arange, argsort, array, bincount, concatenate, empty, float32, float64, inf, int32, lexsort, ndarray, searchsorted, split, where, zeros
+from numpy.linalg import norm
+
+from .index_file import attach_index_shared_memory, create_index_shared_memory, read_index_file, write_index_file
+from .math_helper import (
+    HitMode, Triangle, BoundingBox, Vec3,
+    boxes_triangles_overlap, segments_boxes_clip, segments_triangles_intersect, spheres_triangles_overlap
+)
+
+
+# slightly skewed so parity rays rarely run exactly through shared edges and vertices of axis aligned geometry
+POINT_INSIDE_DIRECTION: Final[ndarray] = array((0.9998, 0.0173, 0.0089)) / norm((0.9998, 0.0173, 0.0089))
 
 
 @dataclass
 class KDNode:
+    __slots__ = ("bbox", "axis", "triangles", "left", "right")
+
     def __init__(self, bbox: BoundingBox, axis: int) -> None:
         self.bbox = bbox
         self.axis = axis
@@ -71,10 +87,229 @@ class KDNode:
 
 
 
+def build_box_hierarchy(boxes: ndarray, leaf_size: int = 4) -> tuple[ndarray, ndarray, ndarray, ndarray]:
+    # aabb hierarchy over (k, 2, 3) boxes in the flat KdTree layout: node bbox (min, max), children (left, right, -1 if none),
+    # leaf items (start, count) into the returned item index, root = node 0, median splits on the widest axis
+    node_bbox: list[ndarray] = list()
+    node_child: list[tuple[int, int]] = list()
+    node_item: list[tuple[int, int]] = list()
+    item_index: list[ndarray] = list()
+    item_count = 0
+
+    def build(indices: ndarray) -> int:
+        nonlocal item_count
+        node = len(node_bbox)
+        bbox = array((boxes[indices, 0].min(axis=0), boxes[indices, 1].max(axis=0)))
+        node_bbox.append(bbox)
+        node_child.append((-1, -1))
+        node_item.append((0, 0))
+
+        if len(indices) <= leaf_size:
+            node_item[node] = (item_count, len(indices))
+            item_index.append(indices)
+            item_count += len(indices)
+            return node
+
+        axis = (bbox[1] - bbox[0]).argmax()
+        indices = indices[argsort(boxes[indices, :, axis].sum(axis=1), kind="stable")]
+        left = build(indices[:len(indices) // 2])
+        node_child[node] = (left, build(indices[len(indices) // 2:]))
+        return node
+
+    if len(boxes) > 0: build(arange(len(boxes), dtype=int32))
+    return (
+        array(node_bbox, dtype=float32).reshape((-1, 2, 3)),
+        array(node_child, dtype=int32).reshape((-1, 2)),
+        array(node_item, dtype=int32).reshape((-1, 2)),
+        concatenate(item_index).astype(int32) if item_index else zeros(0, dtype=int32)
+    )
+
+
 class KdTree:
     def __init__(self, triangles: list[Triangle]):
-        self.triangles = triangles
-        self.tree = self.build_kd_tree(triangles, 0)
+        self.triangles: list[Triangle] | None = triangles
+        self.tree: KDNode | None = self.build_kd_tree(triangles, 0)
+        self.geometry_hash = self.get_geometry_hash(triangles)
+        self.shared_memory: SharedMemory | None = None
+
+        # flat representation, node i: bbox (min, max), children (left, right, -1 if none), triangles (start, count)
+        self.node_bbox, self.node_child, self.node_triangle, self.triangle_buffer, self.triangle_index = self.flatten(self.tree, triangles)
+        # the node arrays as python lists, built on the first single segment query, see segment_hit
+        self.node_lists: tuple[list, list, list] | None = None
+
+    @classmethod
+    def from_arrays(cls, geometry_hash: bytes, arrays: dict[str, ndarray]) -> "KdTree":
+        kd_tree = cls.__new__(cls)
+        kd_tree.triangles = None
+        kd_tree.tree = None
+        kd_tree.geometry_hash = geometry_hash
+        kd_tree.shared_memory = None
+
+        kd_tree.node_bbox = arrays["node_bbox"]
+        kd_tree.node_child = arrays["node_child"]
+        kd_tree.node_triangle = arrays["node_triangle"]
+        kd_tree.triangle_buffer = arrays["triangle_buffer"]
+        kd_tree.triangle_index = arrays["triangle_index"]
+        kd_tree.node_lists = None
+        return kd_tree
+
+    @classmethod
+    def from_triangle_buffer(cls, triangle_buffer: ndarray) -> "KdTree":
+        return cls([Triangle(*(Vec3(*point) for point in triangle)) for triangle in triangle_buffer.tolist()])
+
+    @classmethod
+    def from_nodes(cls, node_bbox: ndarray, node_child: ndarray, node_triangle: ndarray, triangle_buffer: ndarray) -> "KdTree":
+        # prebuilt hierarchy over an already ordered triangle buffer, e.g. the one embedded in vphys meshes
+        return cls.from_arrays(KdTree.get_buffer_hash(triangle_buffer), dict(
+            node_bbox=node_bbox.astype(float32, copy=False),
+            node_child=node_child.astype(int32, copy=False),
+            node_triangle=node_triangle.astype(int32, copy=False),
+            triangle_buffer=triangle_buffer.astype(float32, copy=False),
+            triangle_index=arange(len(triangle_buffer), dtype=int32),
+        ))
+
+    @classmethod
+    def merge(cls, kd_trees: list["KdTree"]) -> "KdTree":
+        # subtrees are kept as is, only a balanced top level is built over their roots
+        if len(kd_trees) == 0: raise ValueError("Nothing to merge.")
+        if len(kd_trees) == 1: return kd_trees[0]
+
+        top_count = len(kd_trees) - 1
+        node_offsets, slot_offsets = list(), list()
+        node_offset, slot_offset = top_count, 0
+        for kd_tree in kd_trees:
+            node_offsets.append(node_offset)
+            slot_offsets.append(slot_offset)
+            node_offset += len(kd_tree.node_bbox)
+            slot_offset += len(kd_tree.triangle_buffer)
+
+        top_bbox = empty((top_count, 2, 3), dtype=float32)
+        top_child = empty((top_count, 2), dtype=int32)
+        top_used = 0
+
+        def build_top(tree_indices: list[int]) -> tuple[int, ndarray]:
+            nonlocal top_used
+            if len(tree_indices) == 1:
+                return node_offsets[tree_indices[0]], kd_trees[tree_indices[0]].node_bbox[0]
+
+            node = top_used
+            top_used += 1
+            left, left_bbox = build_top(tree_indices[:len(tree_indices) // 2])
+            right, right_bbox = build_top(tree_indices[len(tree_indices) // 2:])
+
+            top_bbox[node] = (
+                where(left_bbox[0] < right_bbox[0], left_bbox[0], right_bbox[0]),
+                where(left_bbox[1] > right_bbox[1], left_bbox[1], right_bbox[1])
+            )
+            top_child[node] = (left, right)
+            return node, top_bbox[node]
+        build_top(list(range(len(kd_trees))))
+
+        triangle_buffer = concatenate([kd_tree.triangle_buffer for kd_tree in kd_trees])
+        triangle_index = concatenate([
+            kd_tree.triangle_index + slot_offset
+            for kd_tree, slot_offset in zip(kd_trees, slot_offsets)
+        ]).astype(int32)
+
+        return cls.from_arrays(KdTree.get_buffer_hash(triangle_buffer[argsort(triangle_index)]), dict(
+            node_bbox=concatenate([top_bbox] + [kd_tree.node_bbox for kd_tree in kd_trees]),
+            node_child=concatenate([top_child] + [
+                where(kd_tree.node_child >= 0, kd_tree.node_child + node_offset, -1)
+                for kd_tree, node_offset in zip(kd_trees, node_offsets)
+            ]).astype(int32),
+            node_triangle=concatenate([zeros((top_count, 2), dtype=int32)] + [
+                kd_tree.node_triangle + (slot_offset, 0)
+                for kd_tree, slot_offset in zip(kd_trees, slot_offsets)
+            ]).astype(int32),
+            triangle_buffer=triangle_buffer,
+            triangle_index=triangle_index,
+        ))
+
+    def to_arrays(self) -> dict[str, ndarray]:
+        return dict(
+            node_bbox=self.node_bbox,
+            node_child=self.node_child,
+            node_triangle=self.node_triangle,
+            triangle_buffer=self.triangle_buffer,
+            triangle_index=self.triangle_index,
+        )
+
+    @classmethod
+    def load(cls, file_name: str, geometry_hash: bytes | None = None) -> "KdTree":
+        file_geometry_hash, arrays = read_index_file(file_name)
+        if geometry_hash is not None and file_geometry_hash != geometry_hash:
+            raise ValueError("Index file %s was built from other geometry." % file_name)
+
+        return cls.from_arrays(file_geometry_hash, arrays)
+
+    def save(self, file_name: str) -> None:
+        write_index_file(file_name, self.geometry_hash, self.to_arrays())
+
+    @classmethod
+    def from_shared_memory(cls, name: str, geometry_hash: bytes | None = None) -> "KdTree":
+        shared_memory, shared_geometry_hash, arrays = attach_index_shared_memory(name)
+        if geometry_hash is not None and shared_geometry_hash != geometry_hash:
+            raise ValueError("Shared index %s was built from other geometry." % name)
+
+        kd_tree = cls.from_arrays(shared_geometry_hash, arrays)
+        kd_tree.shared_memory = shared_memory
+        return kd_tree
+
+    def to_shared_memory(self, name: str) -> SharedMemory:
+        return create_index_shared_memory(name, self.geometry_hash, self.to_arrays())
+
+    @staticmethod
+    def get_triangles_buffer(triangles: list[Triangle]) -> ndarray:
+        return array([
+            tuple((point.x, point.y, point.z) for point in (triangle.p1, triangle.p2, triangle.p3))
+            for triangle in triangles
+        ], dtype=float32).reshape((-1, 3, 3))
+
+    @staticmethod
+    def get_buffer_hash(triangle_buffer: ndarray) -> bytes:
+        return sha256(triangle_buffer.astype(float32).tobytes()).digest()
+
+    @staticmethod
+    def get_geometry_hash(triangles: list[Triangle]) -> bytes:
+        return KdTree.get_buffer_hash(KdTree.get_triangles_buffer(triangles))
+
+    @staticmethod
+    def flatten(tree: KDNode, triangles: list[Triangle]) -> tuple[ndarray, ndarray, ndarray, ndarray, ndarray]:
+        source_index = {id(triangle): index for index, triangle in enumerate(triangles)}
+
+        nodes: list[KDNode] = list()
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if node.right is not None: stack.append(node.right)
+            if node.left is not None: stack.append(node.left)
+        node_position = {id(node): index for index, node in enumerate(nodes)}
+
+        node_bbox = empty((len(nodes), 2, 3), dtype=float32)
+        node_child = zeros((len(nodes), 2), dtype=int32) - 1
+        node_triangle = zeros((len(nodes), 2), dtype=int32)
+        triangle_index = list()
+        for index, node in enumerate(nodes):
+            node_bbox[index] = (
+                (node.bbox.min.x, node.bbox.min.y, node.bbox.min.z),
+                (node.bbox.max.x, node.bbox.max.y, node.bbox.max.z)
+            )
+            if node.left is not None: node_child[index, 0] = node_position[id(node.left)]
+            if node.right is not None: node_child[index, 1] = node_position[id(node.right)]
+
+            if node.triangles is not None:
+                node_triangle[index] = (len(triangle_index), len(node.triangles))
+                triangle_index.extend(source_index[id(triangle)] for triangle in node.triangles)
+
+        triangle_index = array(triangle_index, dtype=int32)
+        triangle_buffer = KdTree.get_triangles_buffer(triangles)[triangle_index]
+        return node_bbox, node_child, node_triangle, triangle_buffer, triangle_index
+
+    def get_triangle(self, slot: int) -> Triangle:
+        if self.triangles is not None: return self.triangles[self.triangle_index[slot]]
+
+        return Triangle(*(Vec3(*point) for point in self.triangle_buffer[slot].tolist()))
 
     @staticmethod
     def build_kd_tree(triangles: list[Triangle], depth: int = 0) -> KDNode:
@@ -128,8 +363,234 @@ class KdTree:
         return node
 
 
-    def ray_intersects_kd_tree(self, ray_origin: Vec3, ray_end: Vec3) -> Triangle | None:
-        return self.ray_intersects_node(self.tree, ray_origin, ray_end)
+    def ray_intersects_kd_tree(self, ray_origin: Vec3, ray_end: Vec3, mode: HitMode = HitMode.ANY) -> Triangle | None:
+        if mode == HitMode.ALL: raise ValueError("All hits do not fit one triangle, use ray_hits.")
+
+        slot, _ = self.segment_hit(tuple(ray_origin), tuple(ray_end), mode)
+        return self.get_triangle(slot) if slot >= 0 else None
+
+    def segment_hit(self, origin: tuple[float, float, float], end: tuple[float, float, float], mode: HitMode = HitMode.ANY) -> tuple[int, float]:
+        # one segment walked in plain python, same hits as segments_hits, numpy calls per node cost more than they save here
+        # returns (triangle buffer slot, t), slot -1 if nothing is hit
+        EPSILON = 1e-6
+
+        if self.node_lists is None: self.node_lists = self.node_bbox.tolist(), self.node_child.tolist(), self.node_triangle.tolist()
+        node_bbox, node_child, node_triangle = self.node_lists
+        direction = tuple(end[axis] - origin[axis] for axis in range(3))
+
+        def clip(bbox: list[list[float]]) -> float | None:
+            # t where the segment enters the box, None if it misses
+            t_min, t_max = 0.0, 1.0
+            for axis in range(3):
+                if direction[axis] == 0:
+                    if not bbox[0][axis] <= origin[axis] <= bbox[1][axis]: return None
+                    continue
+                t1, t2 = (bbox[0][axis] - origin[axis]) / direction[axis], (bbox[1][axis] - origin[axis]) / direction[axis]
+                t_min, t_max = max(t_min, min(t1, t2)), min(t_max, max(t1, t2))
+            return t_min if t_min <= t_max else None
+
+        def triangle_t(triangle: list[list[float]]) -> float | None:
+            p1, p2, p3 = triangle
+            edge1 = (p2[0] - p1[0], p2[1] - p1[1], p2[2] - p1[2])
+            edge2 = (p3[0] - p1[0], p3[1] - p1[1], p3[2] - p1[2])
+            h = (
+                direction[1] * edge2[2] - direction[2] * edge2[1],
+                direction[2] * edge2[0] - direction[0] * edge2[2],
+                direction[0] * edge2[1] - direction[1] * edge2[0]
+            )
+            a = edge1[0] * h[0] + edge1[1] * h[1] + edge1[2] * h[2]
+            if abs(a) < EPSILON: return None
+
+            f = 1.0 / a
+            s = (origin[0] - p1[0], origin[1] - p1[1], origin[2] - p1[2])
+            u = f * (s[0] * h[0] + s[1] * h[1] + s[2] * h[2])
+            if not 0.0 <= u <= 1.0: return None
+
+            q = (s[1] * edge1[2] - s[2] * edge1[1], s[2] * edge1[0] - s[0] * edge1[2], s[0] * edge1[1] - s[1] * edge1[0])
+            v = f * (direction[0] * q[0] + direction[1] * q[1] + direction[2] * q[2])
+            if v < 0.0 or u + v > 1.0: return None
+
+            t = f * (edge2[0] * q[0] + edge2[1] * q[1] + edge2[2] * q[2])
+            return t if EPSILON < t < 1.0 else None
+
+        slot, t_max = -1, 1.0
+        stack = [(0, t_enter)] if len(node_bbox) > 0 and (t_enter := clip(node_bbox[0])) is not None else []
+        while stack:
+            node, t_enter = stack.pop()
+            if mode == HitMode.CLOSEST and slot >= 0 and t_enter >= t_max: continue
+
+            triangle_start, triangle_count = node_triangle[node]
+            if triangle_count > 0:
+                for offset, triangle in enumerate(self.triangle_buffer[triangle_start:triangle_start + triangle_count].tolist()):
+                    if (t := triangle_t(triangle)) is None or (slot >= 0 and t >= t_max): continue
+                    slot, t_max = triangle_start + offset, t
+                    if mode == HitMode.ANY: return slot, t_max
+                continue
+
+            # nearer child on top of the stack
+            children = [(child, child_enter) for child in node_child[node] if child >= 0 and (child_enter := clip(node_bbox[child])) is not None]
+            if mode != HitMode.CLOSEST or len(children) < 2 or children[0][1] <= children[1][1]: children.reverse()
+            stack.extend(children)
+        return slot, t_max
+
+    def ray_hits(self, ray_origin: Vec3, ray_end: Vec3, mode: HitMode = HitMode.ALL) -> list[tuple[Triangle, float]]:
+        # (triangle, t) with the hit point at ray_origin + t * (ray_end - ray_origin)
+        _, slots, t = self.segments_hits(
+            array((tuple(ray_origin),), dtype=float64),
+            array((tuple(ray_end),), dtype=float64),
+            mode
+        )
+        return [(self.get_triangle(slot), hit_t) for slot, hit_t in zip(slots.tolist(), t.tolist())]
+
+    def segments_intersect(self, origins: ndarray, ends: ndarray, mode: HitMode = HitMode.ANY) -> ndarray:
+        # returns the triangle buffer slot of the first (any) or nearest (closest) hit per segment, -1 if none
+        if mode == HitMode.ALL: raise ValueError("All hits do not fit one slot per segment, use segments_hits.")
+
+        hits = zeros(len(origins), dtype=int32) - 1
+        segments, slots, _ = self.segments_hits(origins, ends, mode)
+        hits[segments] = slots
+        return hits
+
+    def segments_hits(self, origins: ndarray, ends: ndarray, mode: HitMode = HitMode.ANY) -> tuple[ndarray, ndarray, ndarray]:
+        # hits as (segment index, triangle buffer slot, t), ordered by segment then t for closest and all
+        # any and closest keep at most one hit per segment
+        origins = origins.astype(float64, copy=False)
+        directions = ends - origins
+        slots = zeros(len(origins), dtype=int32) - 1
+        t_max = zeros(len(origins), dtype=float64) + 1.0
+        segment_pairs, slot_pairs, t_pairs = [empty(0, dtype=int32)], [empty(0, dtype=int32)], [empty(0, dtype=float64)]
+
+        t_enter, t_exit = segments_boxes_clip(origins, directions, self.node_bbox[0, 0], self.node_bbox[0, 1])
+        segments = (t_enter <= t_exit).nonzero()[0].astype(int32)
+        stack = [(0, segments, t_enter[segments])]
+        while stack:
+            node, segments, t_enter = stack.pop()
+            match mode:
+                case HitMode.ANY: visit = slots[segments] < 0
+                case HitMode.CLOSEST: visit = t_enter < t_max[segments]
+                case _: visit = slice(None)
+            segments, t_enter = segments[visit], t_enter[visit]
+            if len(segments) == 0: continue
+
+            triangle_start, triangle_count = self.node_triangle[node]
+            if triangle_count > 0:
+                hit, t = segments_triangles_intersect(
+                    origins[segments], directions[segments],
+                    self.triangle_buffer[triangle_start:triangle_start + triangle_count]
+                )
+                match mode:
+                    case HitMode.ANY:
+                        is_hit = hit.any(axis=1)
+                        first = hit[is_hit].argmax(axis=1)
+                        slots[segments[is_hit]] = triangle_start + first
+                        t_max[segments[is_hit]] = t[is_hit, first]
+                    case HitMode.CLOSEST:
+                        t = where(hit & (t < t_max[segments, None]), t, inf)
+                        nearest = t.argmin(axis=1)
+                        t = t[arange(len(segments)), nearest]
+                        is_hit = t < inf
+                        slots[segments[is_hit]] = triangle_start + nearest[is_hit]
+                        t_max[segments[is_hit]] = t[is_hit]
+                    case _:
+                        segment_index, triangle_offset = hit.nonzero()
+                        segment_pairs.append(segments[segment_index])
+                        slot_pairs.append(triangle_start + triangle_offset.astype(int32))
+                        t_pairs.append(t[segment_index, triangle_offset])
+                continue
+
+            children = list()
+            for child in self.node_child[node]:
+                if child < 0: continue
+                child_enter, child_exit = segments_boxes_clip(
+                    origins[segments], directions[segments], self.node_bbox[child, 0], self.node_bbox[child, 1]
+                )
+                children.append((child, child_enter, child_enter <= child_exit))
+
+            # closest descends front to back in the order most of the batch enters the children,
+            # a single ray gets exact ordering, splitting the batch per segment costs more than it saves
+            if mode != HitMode.CLOSEST or len(children) < 2 or (children[0][1] <= children[1][1]).sum() * 2 >= len(segments):
+                children.reverse()
+
+            for child, child_enter, child_visit in children:
+                if child_visit.any(): stack.append((child, segments[child_visit], child_enter[child_visit]))
+
+        if mode != HitMode.ALL:
+            is_hit = (slots >= 0).nonzero()[0].astype(int32)
+            return is_hit, slots[is_hit], t_max[is_hit]
+
+        segments, slots, t = concatenate(segment_pairs), concatenate(slot_pairs), concatenate(t_pairs)
+        order = lexsort((t, segments))
+        return segments[order], slots[order], t[order]
+
+    def volumes_overlap(self, boxes_min: ndarray, boxes_max: ndarray, overlap: Callable[[ndarray, ndarray], ndarray]) -> tuple[ndarray, ndarray]:
+        # nodes are culled by the query bounding boxes, leaves by overlap(query indices, triangles) -> mask
+        # returns (query index, triangle buffer slot) pairs
+        query_pairs, slot_pairs = [empty(0, dtype=int32)], [empty(0, dtype=int32)]
+
+        stack = [(0, arange(len(boxes_min), dtype=int32))]
+        while stack:
+            node, queries = stack.pop()
+            bbox = self.node_bbox[node]
+            queries = queries[((boxes_min[queries] <= bbox[1]) & (boxes_max[queries] >= bbox[0])).all(axis=1)]
+            if len(queries) == 0: continue
+
+            triangle_start, triangle_count = self.node_triangle[node]
+            if triangle_count > 0:
+                query_index, triangle_offset = overlap(queries, self.triangle_buffer[triangle_start:triangle_start + triangle_count]).nonzero()
+                query_pairs.append(queries[query_index])
+                slot_pairs.append(triangle_start + triangle_offset.astype(int32))
+                continue
+
+            left, right = self.node_child[node]
+            if right >= 0: stack.append((right, queries))
+            if left >= 0: stack.append((left, queries))
+        return concatenate(query_pairs), concatenate(slot_pairs)
+
+    def group_triangles(self, query_count: int, queries: ndarray, slots: ndarray) -> list[ndarray]:
+        # original triangle indices per query, ascending
+        triangles = self.triangle_index[slots]
+        order = lexsort((triangles, queries))
+        return split(triangles[order], searchsorted(queries[order], arange(1, query_count)))
+
+    def boxes_query(self, boxes_min: ndarray, boxes_max: ndarray) -> list[ndarray]:
+        # triangles overlapping each box (m, 3)
+        boxes_min = boxes_min.astype(float64, copy=False)
+        boxes_max = boxes_max.astype(float64, copy=False)
+
+        queries, slots = self.volumes_overlap(
+            boxes_min, boxes_max,
+            lambda queries, triangles: boxes_triangles_overlap(boxes_min[queries], boxes_max[queries], triangles)
+        )
+        return self.group_triangles(len(boxes_min), queries, slots)
+
+    def box_query(self, box_min: Vec3, box_max: Vec3) -> ndarray:
+        return self.boxes_query(array((tuple(box_min),), dtype=float64), array((tuple(box_max),), dtype=float64))[0]
+
+    def spheres_query(self, centers: ndarray, radii: ndarray) -> list[ndarray]:
+        # triangles overlapping each sphere, centers (m, 3), radii (m,)
+        centers = centers.astype(float64, copy=False)
+        radii = radii.astype(float64, copy=False)
+
+        queries, slots = self.volumes_overlap(
+            centers - radii[:, None], centers + radii[:, None],
+            lambda queries, triangles: spheres_triangles_overlap(centers[queries], radii[queries], triangles)
+        )
+        return self.group_triangles(len(centers), queries, slots)
+
+    def sphere_query(self, center: Vec3, radius: float) -> ndarray:
+        return self.spheres_query(array((tuple(center),), dtype=float64), array((radius,), dtype=float64))[0]
+
+    def points_inside(self, points: ndarray) -> ndarray:
+        # crossing parity of a ray leaving the whole tree, only meaningful for closed meshes
+        points = points.astype(float64, copy=False)
+        root = self.node_bbox[0].astype(float64)
+        length = norm(root[1] - root[0]) + norm(points - (root[0] + root[1]) / 2, axis=1) + 1.0
+
+        segments, _, _ = self.segments_hits(points, points + POINT_INSIDE_DIRECTION * length[:, None], HitMode.ALL)
+        return bincount(segments, minlength=len(points)) % 2 == 1
+
+    def point_inside(self, point: Vec3) -> bool:
+        return bool(self.points_inside(array((tuple(point),), dtype=float64))[0])
 
 
     def ray_intersects_node(self, node: KDNode, ray_origin: Vec3, ray_end: Vec3) -> Triangle | None:
@@ -149,8 +610,19 @@ class KdTree:
             self.ray_intersects_node(node.right, ray_origin, ray_end)
         )
 
-    def ray_intersects_triangle(self, ray_origin: Vec3, ray_end: Vec3) -> Triangle | None:
-        for triangle in self.triangles:
-            if triangle.intersect_check(ray_origin, ray_end):
-                return triangle
-        return None
\ No newline at end of file
+    def ray_intersects_triangle(self, ray_origin: Vec3, ray_end: Vec3, mode: HitMode = HitMode.ANY) -> Triangle | None:
+        if mode == HitMode.ALL: raise ValueError("All hits do not fit one triangle, use ray_hits.")
+        if self.triangles is not None and mode == HitMode.ANY:
+            for triangle in self.triangles:
+                if triangle.intersect_check(ray_origin, ray_end):
+                    return triangle
+            return None
+
+        origin = array((tuple(ray_origin),), dtype=float64)
+        hit, t = segments_triangles_intersect(origin, array((tuple(ray_end),), dtype=float64) - origin, self.triangle_buffer)
+        if not hit[0].any(): return None
+
+        # lowest original index among the hits, or among the nearest ones
+        hit_slots = hit[0].nonzero()[0]
+        if mode == HitMode.CLOSEST: hit_slots = hit_slots[t[0, hit_slots] == t[0, hit_slots].min()]
+        return self.get_triangle(hit_slots[self.triangle_index[hit_slots].argmin()])
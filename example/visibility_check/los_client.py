@@ -0,0 +1,44 @@
+from json import dumps, loads
+from socket import create_connection, socket
+from typing import Final, Iterable
+
+
+# stdlib only, producers do not need numpy or the indexes to ask
+LOS_DEFAULT_HOST: Final[str] = "127.0.0.1"
+LOS_DEFAULT_PORT: Final[int] = 27960
+
+
+class LineOfSightClient:
+    def __init__(self, host: str = LOS_DEFAULT_HOST, port: int = LOS_DEFAULT_PORT, unix_path: str | None = None) -> None:
+        if unix_path is not None:
+            from socket import AF_UNIX
+
+            self.socket = socket(AF_UNIX)
+            self.socket.connect(unix_path)
+        else:
+            self.socket = create_connection((host, port))
+
+        self.file = self.socket.makefile("rwb")
+        self.request_id = 0
+
+    def __enter__(self) -> "LineOfSightClient": return self
+    def __exit__(self, _, __, ___) -> None: self.close()
+
+    def close(self) -> None:
+        self.file.close()
+        self.socket.close()
+
+    def request(self, **kwargs) -> dict:
+        self.request_id += 1
+        self.file.write(dumps(dict(id=self.request_id, **kwargs)).encode() + b"\n")
+        self.file.flush()
+
+        response = loads(self.file.readline())
+        if "error" in response: raise ValueError(response["error"])
+        return response
+
+    def is_visible(self, map_name: str, segments: Iterable[tuple[Iterable[float], Iterable[float]]]) -> list[bool]:
+        return self.request(map=map_name, segments=[(*origin, *end) for origin, end in segments])["visible"]
+
+    def stats(self) -> dict[str, float]:
+        return self.request(stats=True)["stats"]
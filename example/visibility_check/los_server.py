@@ -0,0 +1,195 @@
+from argparse import ArgumentParser
+from asyncio import AbstractEventLoop, Event, Future, StreamReader, StreamWriter, get_running_loop, run, sleep, start_server, start_unix_server
+from collections import deque
+from dataclasses import dataclass, field
+from json import dumps, loads
+from os.path import exists
+from time import perf_counter
+from typing import Final
+
+from numpy import array, concatenate, float64, ndarray, zeros
+
+from .convex_hull import ConvexHulls
+from .index_file import read_index_file
+from .kd_tree import KdTree
+from .los_client import LOS_DEFAULT_HOST, LOS_DEFAULT_PORT
+
+
+# how long the first query of a batch waits for others to join, and the most segments per batch
+LOS_BATCH_WINDOW: Final[float] = 0.002
+LOS_BATCH_SIZE: Final[int] = 8192
+LOS_LATENCY_SAMPLES: Final[int] = 10000
+
+
+class LineOfSightMap:
+    def __init__(self, kd_tree: KdTree | None, convex_hulls: ConvexHulls | None) -> None:
+        self.kd_tree = kd_tree
+        self.convex_hulls = convex_hulls
+
+    @classmethod
+    def load(cls, file_name: str, layer: str = "0_0") -> "LineOfSightMap":
+        # files written by map_parse.write_layers: <file_name>.geometry, <file_name>_<layer>.(kdt|hulls)
+        # the kd tree has to match the layer triangles in the geometry, a stale one is rebuilt in memory like main.load_kd_tree does
+        _, geometry = read_index_file("%s.geometry" % file_name)
+        if (indices := geometry.get("indices_%s" % layer)) is None: raise ValueError("Layer %s is not in %s.geometry." % (layer, file_name))
+        triangle_buffer = geometry["vertices"][indices]
+
+        kd_tree_file, hulls_file = "%s_%s.kdt" % (file_name, layer), "%s_%s.hulls" % (file_name, layer)
+        kd_tree = None
+        if len(triangle_buffer) > 0:
+            try: kd_tree = KdTree.load(kd_tree_file, KdTree.get_buffer_hash(triangle_buffer)) if exists(kd_tree_file) else None
+            except ValueError: pass
+            if kd_tree is None: kd_tree = KdTree.from_triangle_buffer(triangle_buffer)
+
+        return cls(kd_tree, ConvexHulls.load(hulls_file) if exists(hulls_file) else None)
+
+    def segments_blocked(self, origins: ndarray, ends: ndarray) -> ndarray:
+        blocked = zeros(len(origins), dtype=bool)
+        if self.kd_tree is not None:
+            blocked |= self.kd_tree.segments_intersect(origins, ends) >= 0
+        if self.convex_hulls is not None and not blocked.all():
+            open_segments = (~blocked).nonzero()[0]
+            blocked[open_segments] = self.convex_hulls.segments_intersect(origins[open_segments], ends[open_segments]) >= 0
+        return blocked
+
+
+@dataclass(slots=True)
+class PendingQuery:
+    origins: ndarray
+    ends: ndarray
+    future: Future
+    start_time: float
+
+
+@dataclass(slots=True)
+class LineOfSightMetrics:
+    start_time: float = field(default_factory=perf_counter)
+    queries: int = 0
+    segments: int = 0
+    batches: int = 0
+    latencies: deque = field(default_factory=lambda: deque(maxlen=LOS_LATENCY_SAMPLES))
+
+    def to_dict(self) -> dict[str, float]:
+        uptime = perf_counter() - self.start_time
+        latencies = sorted(self.latencies)
+
+        def percentile(value: float) -> float:
+            return latencies[min(int(len(latencies) * value), len(latencies) - 1)] * 1000 if latencies else 0.0
+
+        return dict(
+            uptime=uptime,
+            queries=self.queries,
+            segments=self.segments,
+            batches=self.batches,
+            segments_per_batch=self.segments / self.batches if self.batches else 0.0,
+            segments_per_second=self.segments / uptime if uptime > 0 else 0.0,
+            latency_p50_ms=percentile(0.5),
+            latency_p95_ms=percentile(0.95),
+            latency_p99_ms=percentile(0.99),
+        )
+
+
+class LineOfSightServer:
+    # newline delimited json, one request per line:
+    #   {"id": 1, "map": "de_dust2", "segments": [[ox, oy, oz, ex, ey, ez], ...]} -> {"id": 1, "visible": [true, ...]}
+    #   {"id": 2, "stats": true} -> {"id": 2, "stats": {...}}
+    def __init__(self, maps: dict[str, LineOfSightMap], batch_window: float = LOS_BATCH_WINDOW, batch_size: int = LOS_BATCH_SIZE) -> None:
+        self.maps = maps
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+
+        self.pending: dict[str, list[PendingQuery]] = {name: list() for name in maps}
+        self.pending_event: dict[str, Event] = {name: Event() for name in maps}
+        self.metrics = LineOfSightMetrics()
+
+    async def batch_loop(self, map_name: str) -> None:
+        # queries arriving while a batch waits or runs are coalesced into the next vectorized query
+        loop: AbstractEventLoop = get_running_loop()
+        line_of_sight_map = self.maps[map_name]
+        while True:
+            await self.pending_event[map_name].wait()
+            await sleep(self.batch_window)
+            self.pending_event[map_name].clear()
+
+            queries, segment_count = list(), 0
+            while self.pending[map_name] and (not queries or segment_count + len(self.pending[map_name][0].origins) <= self.batch_size):
+                queries.append(self.pending[map_name].pop(0))
+                segment_count += len(queries[-1].origins)
+            if self.pending[map_name]: self.pending_event[map_name].set()
+
+            origins = concatenate([query.origins for query in queries])
+            ends = concatenate([query.ends for query in queries])
+            try: blocked = await loop.run_in_executor(None, line_of_sight_map.segments_blocked, origins, ends)
+            except Exception as exception:
+                for query in queries: query.future.set_exception(exception)
+                continue
+
+            self.metrics.batches += 1
+            offset = 0
+            for query in queries:
+                query.future.set_result(blocked[offset:offset + len(query.origins)])
+                offset += len(query.origins)
+                self.metrics.latencies.append(perf_counter() - query.start_time)
+
+    async def query(self, map_name: str, segments: list[list[float]]) -> list[bool]:
+        if map_name not in self.maps: raise ValueError("Map %s is not loaded." % map_name)
+
+        segments_array = array(segments, dtype=float64).reshape((-1, 6))
+        future = get_running_loop().create_future()
+        self.pending[map_name].append(PendingQuery(segments_array[:, :3], segments_array[:, 3:], future, perf_counter()))
+        self.pending_event[map_name].set()
+
+        self.metrics.queries += 1
+        self.metrics.segments += len(segments_array)
+        return (~await future).tolist()
+
+    async def handle_client(self, reader: StreamReader, writer: StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                # malformed json or a request that is not an object still gets an answer, with a null id
+                response = dict(id=None)
+                try:
+                    request = loads(line)
+                    response.update(id=request.get("id"))
+                    if request.get("stats"): response.update(stats=self.metrics.to_dict())
+                    else: response.update(visible=await self.query(request["map"], request["segments"]))
+                except (AttributeError, KeyError, TypeError, ValueError) as exception:
+                    response.update(error=str(exception))
+
+                writer.write(dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = LOS_DEFAULT_HOST, port: int = LOS_DEFAULT_PORT, unix_path: str | None = None) -> None:
+        batch_tasks = [get_running_loop().create_task(self.batch_loop(name)) for name in self.maps]
+        server = (
+            await start_unix_server(self.handle_client, unix_path) if unix_path is not None else
+            await start_server(self.handle_client, host, port)
+        )
+        try:
+            async with server: await server.serve_forever()
+        finally:
+            for task in batch_tasks: task.cancel()
+
+
+def main() -> None:
+    argument_parser = ArgumentParser(description="Keeps map indexes resident and answers batched line of sight queries.")
+    argument_parser.add_argument("maps", nargs="+", help="name=file_name[:layer], file_name as passed to map_parse.write_layers")
+    argument_parser.add_argument("--host", default=LOS_DEFAULT_HOST)
+    argument_parser.add_argument("--port", type=int, default=LOS_DEFAULT_PORT)
+    argument_parser.add_argument("--unix", default=None, help="serve on this unix socket instead of tcp")
+    argument_parser.add_argument("--batch-window", type=float, default=LOS_BATCH_WINDOW)
+    arguments = argument_parser.parse_args()
+
+    maps = dict()
+    for map_argument in arguments.maps:
+        name, _, file_name = map_argument.partition("=")
+        file_name, _, layer = file_name.partition(":")
+        maps.update({name: LineOfSightMap.load(file_name, layer or "0_0")})
+
+    run(LineOfSightServer(maps, arguments.batch_window).serve(arguments.host, arguments.port, arguments.unix))
+
+
+if __name__ == '__main__':
+    main()
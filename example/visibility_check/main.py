@@ -1,10 +1,13 @@
 from operator import itemgetter
-from pickle import load
-from struct import unpack
+from os.path import exists
 from time import perf_counter
 
+from numpy import ndarray
+
+from .convex_hull import ConvexHulls
+from .index_file import read_index_file
 from .kd_tree import KdTree
-from .math_helper import Triangle, Vec3, world_2_screen, Vec2
+from .math_helper import Vec3, world_2_screen, Vec2
 from .offsets import LOCAL_PLAYER_PAWN, VIEW_MATRIX, M_V_OLD_ORIGIN
 from .pyMeow import pyMeow as meow
 from .pyMeow import Module
@@ -21,30 +24,23 @@ class TimeCounter:
             print("%s: %.8f ms" % (self.prefix, (perf_counter() - self.start_time) * 1000))
 
 
-def read_triangles_by_pkl(file_location: str) -> list[Triangle]:
-    with open(file_location, "rb") as file:
-        return load(file)
+def read_triangles_by_geometry(file_location: str, layer: str) -> ndarray:
+    _, arrays = read_index_file(file_location)
+    return arrays["vertices"][arrays["indices_%s" % layer]]
 
 
-def read_triangles_by_tri(file_location: str) -> list[Triangle]:
-    with open(file_location, "r") as file:
-        content = file.read()
-    bytes_content = bytes.fromhex(content)
+def load_kd_tree(geometry_location: str, layer: str, index_location: str) -> KdTree | None:
+    # layers with hulls only have no triangles and no .kdt
+    triangle_buffer = read_triangles_by_geometry(geometry_location, layer)
+    if len(triangle_buffer) == 0: return None
 
-    triangles: list[Triangle] = list()
-    for index in range(len(bytes_content) // 36):
-        index *= 36
+    if exists(index_location):
+        try: return KdTree.load(index_location, KdTree.get_buffer_hash(triangle_buffer))
+        except ValueError: pass
 
-        p1, p2, p3 = [
-            Vec3(*unpack("fff", byte_split))
-            for byte_split in itemgetter(
-                slice(index, index + 12),
-                slice(index + 12, index + 24),
-                slice(index + 24, index + 36)
-            )(bytes_content)
-        ]
-        triangles.append(Triangle(p1, p2, p3))
-    return triangles
+    kd_tree = KdTree.from_triangle_buffer(triangle_buffer)
+    kd_tree.save(index_location)
+    return kd_tree
 
 
 def main() -> None:
@@ -55,8 +51,9 @@ def main() -> None:
     local_player_pos_address = local_Player_pawn_address + M_V_OLD_ORIGIN
     # local_player_head_pos_address = cs2.u64(cs2.u64(cs2.u64(local_Player_pawn_address + M_P_GAME_SCENE_NODE) + M_MODEL_STATE) + 0x80) + 0x20 * 6
 
-    triangles = read_triangles_by_pkl("output.pkl")
-    kd_tree = KdTree(triangles)
+    # part 0, collision attribute 0, see map_parse.write_layers
+    kd_tree = load_kd_tree("output.geometry", "0_0", "output_0_0.kdt")
+    convex_hulls = ConvexHulls.load("output_0_0.hulls")
 
     target_points = (
         Vec3(124, -357, -110),
@@ -80,13 +77,14 @@ def main() -> None:
             local_player_pos.z += 64
 
             for target_point in target_points:
-                intersects = kd_tree.ray_intersects_kd_tree(local_player_pos, target_point)
+                intersects = kd_tree.ray_intersects_kd_tree(local_player_pos, target_point) if kd_tree is not None else None
+                hull_intersects = convex_hulls.ray_intersects_hulls(local_player_pos, target_point) if intersects is None else None
 
                 point = world_2_screen(view_matrix, screen, target_point)
                 if point is not None:
                     meow.draw_circle(
                         *point, radius=2,
-                        color=meow.new_color(255, 0, 0, 255) if intersects is not None else meow.new_color(0, 255, 0, 255)
+                        color=meow.new_color(255, 0, 0, 255) if intersects is not None or hull_intersects is not None else meow.new_color(0, 255, 0, 255)
                     )
 
                 if intersects is not None:
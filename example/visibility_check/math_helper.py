@@ -1,12 +1,19 @@
 from dataclasses import dataclass
+from enum import IntEnum
 
 from math import sqrt, atan2, degrees
 from typing import Iterable
 
-from numpy import array, float64
+from numpy import array, eye, float64, ndarray, errstate, fmin, fmax, abs as np_abs, einsum, cross, clip, where, minimum
 
 
-@dataclass
+class HitMode(IntEnum):
+    ANY     = 0x0 # first hit found, cheapest
+    CLOSEST = 0x1 # hit with the smallest t
+    ALL     = 0x2 # every hit, ordered by t
+
+
+@dataclass(slots=True)
 class Vec2:
     x: float = .0
     y: float = .0
@@ -65,7 +72,7 @@ class Vec2:
         degree = degrees(angle)
         return degree
 
-@dataclass
+@dataclass(slots=True)
 class Vec3:
     x: float = .0
     y: float = .0
@@ -159,7 +166,7 @@ class Vec3:
         ))
 
 
-@dataclass
+@dataclass(slots=True)
 class Triangle:
     p1: Vec3
     p2: Vec3
@@ -191,7 +198,7 @@ class Triangle:
         return False  # 这意味着光线与三角形不相交或者在三角形的边界上
 
 
-@dataclass
+@dataclass(slots=True)
 class BoundingBox:
     min: Vec3
     max: Vec3
@@ -245,4 +252,91 @@ def world_2_screen(view_matrix: list[float], screen: Vec2, pos: Vec3, out_of_scr
     return Vec2(
         (screen.x / 2 * ndc.x) + (ndc.x + screen.x / 2),
         -(screen.y / 2 * ndc.y) + (ndc.y + screen.y / 2)
-    )
\ No newline at end of file
+    )
+
+def segments_boxes_clip(origins: ndarray, directions: ndarray, boxes_min: ndarray, boxes_max: ndarray) -> tuple[ndarray, ndarray]:
+    # origins / directions: (m, 3), boxes: (m, 3) or (3,), segment is origin + t * direction for t in [0, 1]
+    # returns (t_min, t_max) of the part inside the box, empty when t_min > t_max
+    with errstate(divide="ignore", invalid="ignore"):
+        inv_direction = 1.0 / directions
+        t1 = (boxes_min - origins) * inv_direction
+        t2 = (boxes_max - origins) * inv_direction
+
+    # fmin / fmax skip the nan of 0 * inf when the origin lies on a slab plane
+    return fmax(fmin(t1, t2).max(axis=-1), 0.0), fmin(fmax(t1, t2).min(axis=-1), 1.0)
+
+
+def segments_boxes_intersect(origins: ndarray, directions: ndarray, boxes_min: ndarray, boxes_max: ndarray) -> ndarray:
+    t_min, t_max = segments_boxes_clip(origins, directions, boxes_min, boxes_max)
+    return t_min <= t_max
+
+
+def segments_triangles_intersect(origins: ndarray, directions: ndarray, triangles: ndarray) -> tuple[ndarray, ndarray]:
+    # origins / directions: (m, 3), triangles: (k, 3, 3) -> (hit mask, t) both shaped (m, k)
+    EPSILON = 1e-6
+
+    p1 = triangles[None, :, 0]
+    edge1 = triangles[None, :, 1] - p1
+    edge2 = triangles[None, :, 2] - p1
+    ray_direction = directions[:, None]
+
+    h = cross(ray_direction, edge2)
+    a = einsum("...i,...i", edge1, h)
+    parallel = np_abs(a) < EPSILON
+
+    with errstate(divide="ignore", invalid="ignore"):
+        f = 1.0 / a
+        s = origins[:, None] - p1
+        u = f * einsum("...i,...i", s, h)
+        q = cross(s, edge1)
+        v = f * einsum("...i,...i", ray_direction, q)
+        t = f * einsum("...i,...i", edge2, q)
+
+    hit = ~parallel & (u >= 0.0) & (u <= 1.0) & (v >= 0.0) & (u + v <= 1.0) & (t > EPSILON) & (t < 1.0)
+    return hit, t
+
+
+def boxes_triangles_overlap(boxes_min: ndarray, boxes_max: ndarray, triangles: ndarray) -> ndarray:
+    # boxes: (m, 3), triangles: (k, 3, 3) -> overlap mask (m, k), separating axis test
+    center = (boxes_min + boxes_max) / 2
+    half = (boxes_max - boxes_min) / 2
+    points = triangles[None] - center[:, None, None]
+    edges = triangles[:, (1, 2, 0)] - triangles
+
+    # box face normals
+    separated = (points.min(axis=2) > half[:, None]).any(axis=-1) | (points.max(axis=2) < -half[:, None]).any(axis=-1)
+
+    # triangle normal
+    normal = cross(edges[:, 0], edges[:, 1])
+    distance = einsum("mkc,kc->mk", points[:, :, 0], normal)
+    separated |= np_abs(distance) > einsum("mc,kc->mk", half, np_abs(normal))
+
+    # box axis x triangle edge
+    axes = cross(eye(3)[None, :, None], edges[:, None]).reshape((-1, 9, 3))
+    projection = einsum("mkvc,kac->mkav", points, axes)
+    radius = einsum("mc,kac->mka", half, np_abs(axes))
+    separated |= ((projection.min(axis=-1) > radius) | (projection.max(axis=-1) < -radius)).any(axis=-1)
+    return ~separated
+
+
+def spheres_triangles_overlap(centers: ndarray, radii: ndarray, triangles: ndarray) -> ndarray:
+    # centers: (m, 3), radii: (m,), triangles: (k, 3, 3) -> overlap mask (m, k)
+    points = centers[:, None, None] - triangles[None]
+    edges = triangles[:, (1, 2, 0)] - triangles
+    normal = cross(edges[:, 0], edges[:, 1])
+    normal_length = einsum("kc,kc->k", normal, normal)
+
+    # closest point on each edge
+    edge_length = einsum("kec,kec->ke", edges, edges)
+    with errstate(divide="ignore", invalid="ignore"):
+        t = clip(einsum("mkec,kec->mke", points, edges) / edge_length, 0.0, 1.0)
+    t = where(edge_length > 0, t, 0.0)
+    offset = points - t[..., None] * edges
+    distance = einsum("mkec,mkec->mke", offset, offset).min(axis=-1)
+
+    # projection onto the plane when it falls inside the triangle
+    inside = (einsum("mkec,kc->mke", cross(edges, points), normal) >= 0).all(axis=-1) & (normal_length > 0)
+    with errstate(divide="ignore", invalid="ignore"):
+        plane_distance = einsum("mkc,kc->mk", points[:, :, 0], normal) ** 2 / normal_length
+    distance = where(inside, minimum(distance, plane_distance), distance)
+    return distance <= radii[:, None] ** 2
@@ -0,0 +1,477 @@
+from argparse import ArgumentParser
+from enum import IntEnum
+from hashlib import sha256
+from mmap import mmap, ACCESS_READ
+from struct import unpack_from
+from typing import Final, Iterator, Union
+
+from vphys_parser import VphysDict, VphysHex, VphysList, VphysParser
+
+
+
+RESOURCE_HEADER_VERSION: Final[int] = 12
+KV3_TRAILER: Final[int] = 0xFFEEDD00
+KV3_LZ4_WINDOW: Final[int] = 0x10000
+
+# little endian "\x013VK" .. "\x043VK", value is the binary kv3 version
+KV3_MAGICS: Final[dict[int, int]] = {
+    0x4B563301: 1,
+    0x4B563302: 2,
+    0x4B563303: 3,
+    0x4B563304: 4,
+}
+KV3_MAGIC_LEGACY: Final[int] = 0x03564B56
+KV3_MAGIC_5: Final[int] = 0x4B563305
+
+
+class KV3Type(IntEnum):
+    STRING_MULTI           = 0
+    NULL                   = 1
+    BOOLEAN                = 2
+    INT64                  = 3
+    UINT64                 = 4
+    DOUBLE                 = 5
+    STRING                 = 6
+    BINARY_BLOB            = 7
+    ARRAY                  = 8
+    OBJECT                 = 9
+    ARRAY_TYPED            = 10
+    INT32                  = 11
+    UINT32                 = 12
+    BOOLEAN_TRUE           = 13
+    BOOLEAN_FALSE          = 14
+    INT64_ZERO             = 15
+    INT64_ONE              = 16
+    DOUBLE_ZERO            = 17
+    DOUBLE_ONE             = 18
+    FLOAT                  = 19
+    INT16                  = 20
+    UINT16                 = 21
+    INT32_AS_BYTE          = 23
+    ARRAY_TYPE_BYTE_LENGTH = 24
+
+
+class KV3CompressionMethod(IntEnum):
+    NONE = 0
+    LZ4  = 1
+    ZSTD = 2
+
+
+class VphysBinaryDict(VphysDict):
+    __slots__ = ("values",)
+
+    def __init__(self, values: dict[str, object]) -> None:
+        self.values = values
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.values)
+
+    def get_var(self, target_var_name: str) -> Union[int, float, str, "VphysBinaryDict", "VphysBinaryList", "VphysBinaryHex", None]:
+        return self.values.get(target_var_name, None)
+
+    def get_content_hash(self) -> bytes:
+        return content_hash(self)
+
+
+class VphysBinaryList(VphysList):
+    __slots__ = ("values",)
+
+    def __init__(self, values: list[object]) -> None:
+        self.values = values
+
+    def __iter__(self) -> Iterator[Union[int, float, str, "VphysBinaryDict", "VphysBinaryList", "VphysBinaryHex", None]]:
+        return iter(self.values)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def get_index(self, target_index: int) -> Union[int, float, str, "VphysBinaryDict", "VphysBinaryList", "VphysBinaryHex", None]:
+        return self.values[target_index] if 0 <= target_index < len(self.values) else None
+
+    def get_content_hash(self) -> bytes:
+        return content_hash(self)
+
+
+class VphysBinaryHex(VphysHex):
+    __slots__ = ("data",)
+
+    def __init__(self, data: memoryview) -> None:
+        self.data = data
+
+    def get_str(self) -> str | None:
+        return self.data.hex(" ").upper()
+
+    def get_bytes(self) -> memoryview:
+        # zero-copy view into the file or the decompressed kv3 buffer
+        return self.data
+
+    def get_content_hash(self) -> bytes:
+        return content_hash(self)
+
+
+def content_hash(value: object) -> bytes:
+    # type tagged walk of the decoded values, stable across versions of a file as long as the container is unchanged
+    def update(value: object) -> None:
+        match value:
+            case VphysBinaryDict():
+                hasher.update(b"{")
+                for key, item in value.values.items():
+                    hasher.update(key.encode() + b"=")
+                    update(item)
+                hasher.update(b"}")
+            case VphysBinaryList():
+                hasher.update(b"[")
+                for item in value.values: update(item)
+                hasher.update(b"]")
+            case VphysBinaryHex():
+                hasher.update(b"#[%i]" % len(value.data))
+                hasher.update(value.data)
+            case _:
+                hasher.update(("%s:%r," % (type(value).__name__, value)).encode())
+
+    hasher = sha256()
+    update(value)
+    return hasher.digest()
+
+
+class KV3Reader:
+    def __init__(
+            self, buffer: memoryview,
+            bytes_offset: int, shorts_offset: int, ints_offset: int, doubles_offset: int,
+            strings: list[str], types: memoryview, blobs: list[memoryview] | None
+    ) -> None:
+        self.buffer = buffer
+
+        self.bytes_offset = bytes_offset
+        self.shorts_offset = shorts_offset
+        self.ints_offset = ints_offset
+        self.doubles_offset = doubles_offset
+
+        self.strings = strings
+        self.types = types
+        self.types_offset = 0
+        self.blobs = blobs
+        self.blobs_offset = 0
+
+    def read_byte(self) -> int:
+        self.bytes_offset += 1
+        return self.buffer[self.bytes_offset - 1]
+
+    def read_short(self, fmt: str) -> int:
+        self.shorts_offset += 2
+        return unpack_from(fmt, self.buffer, self.shorts_offset - 2)[0]
+
+    def read_int(self, fmt: str = "<i") -> int | float:
+        self.ints_offset += 4
+        return unpack_from(fmt, self.buffer, self.ints_offset - 4)[0]
+
+    def read_double(self, fmt: str) -> int | float:
+        self.doubles_offset += 8
+        return unpack_from(fmt, self.buffer, self.doubles_offset - 8)[0]
+
+    def read_type(self) -> KV3Type:
+        value_type = self.types[self.types_offset]
+        self.types_offset += 1
+
+        # flagged types carry one more byte (resource, panorama ...), the flag is not needed here
+        if value_type & 0x80:
+            value_type &= 0x3F
+            self.types_offset += 1
+        return KV3Type(value_type)
+
+    def read_blob(self) -> memoryview:
+        if self.blobs is None:
+            length = self.read_int()
+            self.bytes_offset += length
+            return self.buffer[self.bytes_offset - length:self.bytes_offset]
+
+        self.blobs_offset += 1
+        return self.blobs[self.blobs_offset - 1]
+
+    def read_value(self, value_type: KV3Type | None = None) -> object:
+        if value_type is None: value_type = self.read_type()
+
+        match value_type:
+            case KV3Type.NULL:
+                return None
+            case KV3Type.BOOLEAN:
+                return self.read_byte() != 0
+            case KV3Type.BOOLEAN_TRUE:
+                return True
+            case KV3Type.BOOLEAN_FALSE:
+                return False
+            case KV3Type.INT64:
+                return self.read_double("<q")
+            case KV3Type.UINT64:
+                return self.read_double("<Q")
+            case KV3Type.DOUBLE:
+                return self.read_double("<d")
+            case KV3Type.INT64_ZERO:
+                return 0
+            case KV3Type.INT64_ONE:
+                return 1
+            case KV3Type.DOUBLE_ZERO:
+                return 0.0
+            case KV3Type.DOUBLE_ONE:
+                return 1.0
+            case KV3Type.INT32:
+                return self.read_int("<i")
+            case KV3Type.UINT32:
+                return self.read_int("<I")
+            case KV3Type.FLOAT:
+                return self.read_int("<f")
+            case KV3Type.INT16:
+                return self.read_short("<h")
+            case KV3Type.UINT16:
+                return self.read_short("<H")
+            case KV3Type.INT32_AS_BYTE:
+                return self.read_byte()
+            case KV3Type.STRING:
+                string_index = self.read_int()
+                return "" if string_index == -1 else self.strings[string_index]
+            case KV3Type.BINARY_BLOB:
+                return VphysBinaryHex(self.read_blob())
+            case KV3Type.ARRAY:
+                return VphysBinaryList([self.read_value() for _ in range(self.read_int())])
+            case KV3Type.ARRAY_TYPED:
+                count = self.read_int()
+                element_type = self.read_type()
+                return VphysBinaryList([self.read_value(element_type) for _ in range(count)])
+            case KV3Type.ARRAY_TYPE_BYTE_LENGTH:
+                count = self.read_byte()
+                element_type = self.read_type()
+                return VphysBinaryList([self.read_value(element_type) for _ in range(count)])
+            case KV3Type.OBJECT:
+                values = dict()
+                for _ in range(self.read_int()):
+                    name = self.strings[self.read_int()]
+                    values.update({name: self.read_value()})
+                return VphysBinaryDict(values)
+
+        raise ValueError("KV3 type %s is not supported." % value_type.name)
+
+
+class VphysBinaryParser:
+    # the decoded tree is never written after __init__, sharing one parser between threads is safe
+    def __init__(self, content: bytes | memoryview | mmap) -> None:
+        self.content = memoryview(content)
+        self.main_dict = self.read_kv3(self.get_resource_block(self.content, "DATA"))
+
+
+    @classmethod
+    def from_file_name(cls, file_name: str) -> "VphysBinaryParser":
+        # blobs of uncompressed files stay views into the mapping
+        with open(file_name, "rb") as vphys_file:
+            return VphysBinaryParser(mmap(vphys_file.fileno(), 0, access=ACCESS_READ))
+
+
+    @staticmethod
+    def get_resource_block(content: memoryview, block_type: str) -> memoryview:
+        _, header_version, _, block_offset, block_count = unpack_from("<IHHII", content, 0)
+        if header_version != RESOURCE_HEADER_VERSION: raise ValueError("Resource header version %i is not supported." % header_version)
+
+        entry = 8 + block_offset
+        for _ in range(block_count):
+            name, offset, size = unpack_from("<4sII", content, entry)
+            if name.decode("ascii", "replace") == block_type:
+                start = entry + 4 + offset
+                return content[start:start + size]
+            entry += 12
+        raise ValueError("Resource has no %s block." % block_type)
+
+
+    @staticmethod
+    def decompress_lz4(data: memoryview, uncompressed_size: int) -> memoryview:
+        from lz4.block import decompress
+
+        return memoryview(decompress(data, uncompressed_size=uncompressed_size))
+
+
+    @staticmethod
+    def decompress_lz4_frames(data: memoryview, frame_sizes: list[int], total_size: int, frame_size: int) -> memoryview:
+        # blobs are one lz4 stream cut into frames, every frame may reference the previous 64kb
+        from lz4.block import decompress
+
+        output = bytearray()
+        offset = 0
+        for compressed_size in frame_sizes:
+            history = bytes(output[-KV3_LZ4_WINDOW:])
+            output += decompress(
+                data[offset:offset + compressed_size],
+                uncompressed_size=min(frame_size, total_size - len(output)),
+                dict=history
+            )
+            offset += compressed_size
+        return memoryview(output)
+
+
+    def read_kv3(self, data: memoryview) -> VphysBinaryDict:
+        magic = unpack_from("<I", data, 0)[0]
+        if magic in (KV3_MAGIC_LEGACY, KV3_MAGIC_5): raise ValueError("KV3 magic %08X is not supported." % magic)
+        if (version := KV3_MAGICS.get(magic)) is None: raise ValueError("Not a binary KV3 block.")
+
+        # magic, format guid
+        offset = 4 + 16
+        compression_method, = unpack_from("<I", data, offset)
+        offset += 4
+
+        frame_size = 0
+        if version >= 2:
+            compression_dictionary, frame_size = unpack_from("<HH", data, offset)
+            offset += 4
+            if compression_dictionary != 0: raise ValueError("KV3 compression dictionaries are not supported.")
+
+        bytes_count, ints_count, doubles_count = unpack_from("<III", data, offset)
+        offset += 12
+
+        shorts_count = 0
+        blob_count, blob_total_size = 0, 0
+        strings_and_types_size = None
+        if version == 1:
+            if compression_method == KV3CompressionMethod.NONE:
+                uncompressed_size, = unpack_from("<I", data, offset)
+                offset += 4
+                compressed_size = uncompressed_size
+            else:
+                uncompressed_size, = unpack_from("<I", data, offset)
+                offset += 4
+                compressed_size = len(data) - offset
+        else:
+            # object and array counts in between are only preallocation hints
+            strings_and_types_size, _, _, uncompressed_size, compressed_size, blob_count, blob_total_size = unpack_from("<IHHIIII", data, offset)
+            offset += 24
+            if version >= 4:
+                shorts_count, _ = unpack_from("<II", data, offset)
+                offset += 8
+
+        match compression_method:
+            case KV3CompressionMethod.NONE:
+                buffer = data[offset:offset + compressed_size]
+            case KV3CompressionMethod.LZ4:
+                buffer = self.decompress_lz4(data[offset:offset + compressed_size], uncompressed_size)
+            case _:
+                raise ValueError("KV3 compression method %i is not supported." % compression_method)
+        blob_data = data[offset + compressed_size:]
+
+        # bytes | shorts (v4) | ints | doubles | strings | types | blob sizes | trailer | lz4 frame sizes
+        buffer_offset = bytes_count
+        buffer_offset += -buffer_offset % 2
+        shorts_offset = buffer_offset
+        buffer_offset += shorts_count * 2
+        buffer_offset += -buffer_offset % 4
+        ints_offset = buffer_offset
+        buffer_offset += ints_count * 4
+        buffer_offset += -buffer_offset % 8
+        doubles_offset = buffer_offset
+        buffer_offset += doubles_count * 8
+
+        # v1 has nothing but the trailer after the types, later versions store the size
+        strings_offset = buffer_offset
+        types_end = len(buffer) - 4 if strings_and_types_size is None else strings_offset + strings_and_types_size
+
+        # only the string table and the type bytes are copied for the terminator search, never the blob sizes or frames behind them
+        strings = list()
+        strings_region = buffer[strings_offset:types_end].tobytes()
+        string_start = 0
+        for _ in range(unpack_from("<i", buffer, ints_offset)[0]):
+            string_end = strings_region.index(b"\x00", string_start)
+            strings.append(strings_region[string_start:string_end].decode("utf-8"))
+            string_start = string_end + 1
+        buffer_offset += string_start
+
+        types = buffer[buffer_offset:types_end]
+        buffer_offset = types_end
+
+        blobs = None
+        if version >= 2:
+            blob_sizes = list(unpack_from("<%iI" % blob_count, buffer, buffer_offset))
+            buffer_offset += blob_count * 4
+        if unpack_from("<I", buffer, buffer_offset)[0] != KV3_TRAILER: raise ValueError("Invalid KV3 trailer.")
+        buffer_offset += 4
+
+        if version >= 2 and blob_count > 0:
+            match compression_method:
+                case KV3CompressionMethod.NONE:
+                    blob_buffer = blob_data[:blob_total_size]
+                case KV3CompressionMethod.LZ4:
+                    if frame_size == 0: raise ValueError("KV3 blob frame size is missing.")
+                    frame_sizes = list()
+                    compressed_total = 0
+                    while len(frame_sizes) * frame_size < blob_total_size:
+                        frame_sizes.append(unpack_from("<H", buffer, buffer_offset)[0])
+                        compressed_total += frame_sizes[-1]
+                        buffer_offset += 2
+                    blob_buffer = self.decompress_lz4_frames(blob_data[:compressed_total], frame_sizes, blob_total_size, frame_size)
+
+            blobs = list()
+            blob_offset = 0
+            for blob_size in blob_sizes:
+                blobs.append(blob_buffer[blob_offset:blob_offset + blob_size])
+                blob_offset += blob_size
+
+        # the first int is the string count
+        reader = KV3Reader(buffer, 0, shorts_offset, ints_offset + 4, doubles_offset, strings, types, blobs)
+        root = reader.read_value()
+        if not isinstance(root, VphysBinaryDict): raise ValueError("KV3 root is not an object.")
+        return root
+
+
+    def search(self, *args: int | str) -> int | float | str | memoryview | None:
+        return self.main_dict.search(*args)
+
+
+# everything map_parse reads below a hull or a mesh
+COMPARE_SHAPE_PATHS: Final[dict[str, tuple[tuple[str, ...], ...]]] = {
+    "m_hulls": (("m_nCollisionAttributeIndex",), ("m_Hull", "m_Vertices"), ("m_Hull", "m_Planes"), ("m_Hull", "m_Faces"), ("m_Hull", "m_Edges")),
+    "m_meshes": (("m_nCollisionAttributeIndex",), ("m_Mesh", "m_Triangles"), ("m_Mesh", "m_Vertices"), ("m_Mesh", "m_Nodes")),
+}
+COMPARE_ATTRIBUTE_PATHS: Final[tuple[tuple[str, ...], ...]] = (("m_CollisionGroupString",), ("m_InteractAsStrings",))
+
+
+def plain_value(value: object) -> object:
+    # blobs as bytes and scalar lists as lists, so both parsers give comparable results
+    match value:
+        case VphysHex(): return bytes(value.get_bytes())
+        case VphysDict(): return VphysDict
+        case VphysList(): return [plain_value(item) for item in value]
+        case _: return value
+
+
+def compare_parsers(binary_parser: VphysBinaryParser, text_parser: VphysParser) -> list[tuple[int | str, ...]]:
+    # search paths where a compiled resource and its decompiled text disagree
+    mismatches = list()
+    def compare(*path: int | str) -> object:
+        binary_value, text_value = plain_value(binary_parser.search(*path)), plain_value(text_parser.search(*path))
+        if binary_value != text_value: mismatches.append(path)
+        return binary_value
+
+    attribute_index = 0
+    while compare("m_collisionAttributes", attribute_index) is not None:
+        for path in COMPARE_ATTRIBUTE_PATHS: compare("m_collisionAttributes", attribute_index, *path)
+        attribute_index += 1
+
+    part_index = 0
+    while compare("m_parts", part_index) is not None:
+        for shape, paths in COMPARE_SHAPE_PATHS.items():
+            shape_index = 0
+            while compare("m_parts", part_index, "m_rnShape", shape, shape_index) is not None:
+                for path in paths: compare("m_parts", part_index, "m_rnShape", shape, shape_index, *path)
+                shape_index += 1
+        part_index += 1
+    return mismatches
+
+
+def main() -> None:
+    argument_parser = ArgumentParser(description="Compares a compiled vphys_c with its decompiled text on everything map_parse reads.")
+    argument_parser.add_argument("compiled")
+    argument_parser.add_argument("decompiled")
+    arguments = argument_parser.parse_args()
+
+    mismatches = compare_parsers(VphysBinaryParser.from_file_name(arguments.compiled), VphysParser.from_file_name(arguments.decompiled))
+    for path in mismatches: print("mismatch: %s" % "/".join(map(str, path)))
+    if mismatches: raise SystemExit(1)
+    print("no mismatches")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from enum import IntEnum
-from typing import Union
+from hashlib import sha256
+from typing import Iterator, Union
 
 
 
@@ -12,6 +13,8 @@ class VphysBoundaryType(IntEnum):
 
 
 class VphysContainer:
+    __slots__ = ("parser", "boundary_start", "boundary_end")
+
     def __init__(self, parser: "VphysParser", boundary_start: int) -> None:
         self.parser = parser
 
@@ -19,6 +22,27 @@ class VphysContainer:
         self.boundary_end = self.get_boundary_end(boundary_start)
 
 
+    def search(self, *args: int | str) -> int | float | str | bytes | None:
+        target_object = self
+        for keyword in args:
+            if isinstance(keyword, str):
+                if isinstance(target_object, VphysDict): target_object = target_object.get_var(keyword)
+                if isinstance(target_object, VphysHex): target_object = target_object.get_bytes()
+                if target_object is None: return None
+            elif isinstance(keyword, int):
+                target_object = target_object.get_index(keyword)
+            else: raise ValueError("Keyword %s does not exist." % keyword)
+
+        return target_object
+
+    def get_content_hash(self) -> bytes:
+        # stable across versions of a file as long as the container text is unchanged, wherever it moved to
+        hasher = sha256()
+        for line in range(self.boundary_start, self.boundary_end + 1):
+            hasher.update(self.parser.get_line_content(line).encode())
+            hasher.update(b"\n")
+        return hasher.digest()
+
     def get_boundary_end(self, start_line: int) -> int | None:
         if start_line not in self.parser.object_boundaries.keys(): raise ValueError("start_line %i is legal." % start_line)
 
@@ -56,6 +80,8 @@ class VphysContainer:
 
 
 class VphysList(VphysContainer):
+    __slots__ = ()
+
     def __init__(self, parser: "VphysParser", boundary_start: int) -> None:
         super().__init__(parser, boundary_start)
 
@@ -66,29 +92,29 @@ class VphysList(VphysContainer):
     def get_index_value(self, target_line: int) -> Union[bool, float, "VphysDict", "VphysList", "VphysHex", None]:
         content = self.parser.get_line_content(target_line)
 
-        match self.parser.get_boundary_mark_type(target_line):
-            case VphysBoundaryType.DICT_PREFIX:
-                return VphysDict(self.parser, target_line)
-            case VphysBoundaryType.LIST_PREFIX:
-                return VphysList(self.parser, target_line)
-            case VphysBoundaryType.HEX_PREFIX:
-                return VphysHex(self.parser, target_line)
-            case None:
-                content = content.replace(",", "").strip()
-
-                if content.lower() in ("true", "false"):
-                    return content.lower() == "true"
-                elif "." in content:
-                    return float(content)
-                else:
-                    return int(content)
-        return None
+        if self.parser.get_boundary_mark_type(target_line) is None:
+            return self.parser.parse_scalar(content.strip().removesuffix(","))
+        return self.parser.get_container(target_line)
+
+    def __iter__(self) -> Iterator[Union[bool, int, float, str, "VphysDict", "VphysList", "VphysHex", None]]:
+        line_index = self.boundary_start + 1
+        while line_index < self.boundary_end:
+            if self.parser.is_blank_line(line_index):
+                line_index += 1
+                continue
+
+            yield self.get_index_value(line_index)
+            line_index = self.get_boundary_end(line_index) + 1 if self.parser.get_boundary_mark_type(line_index) is not None else line_index + 1
 
 
     def get_index(self, target_index: int) -> Union[float, "VphysDict", None]:
         # line_index = self.boundary_start + 1
         # read_index = -1
 
+        if self.parser.concurrent:
+            cached_boundary = self.parser.list_index_cache[self.boundary_start].get(target_index)
+            return self.get_index_value(cached_boundary[0]) if cached_boundary is not None else None
+
         cached_list_boundary = self.parser.list_index_cache.get(self.boundary_start, {})
         if (cached_boundary := cached_list_boundary.get(target_index)) is not None:
             line_index =  cached_boundary[0]
@@ -126,6 +152,8 @@ class VphysList(VphysContainer):
 
 
 class VphysDict(VphysContainer):
+    __slots__ = ()
+
     def __init__(self, parser: "VphysParser", boundary_start: int) -> None:
         super().__init__(parser, boundary_start)
 
@@ -146,23 +174,9 @@ class VphysDict(VphysContainer):
 
 
         if content_var != "":
-            if content_var.lower() in ("true", "false"):
-                return content_var.lower() == "true"
-            elif "." in content_var:
-                return float(content_var)
-            else:
-                return int(content_var)
+            return self.parser.parse_scalar(content_var)
         else:
-            target_line += 1
-
-            match self.parser.get_boundary_mark_type(target_line):
-                case VphysBoundaryType.DICT_PREFIX:
-                    return VphysDict(self.parser, target_line)
-                case VphysBoundaryType.LIST_PREFIX:
-                    return VphysList(self.parser, target_line)
-                case VphysBoundaryType.HEX_PREFIX:
-                    return VphysHex(self.parser, target_line)
-            return None
+            return self.parser.get_container(target_line + 1)
 
     def get_var(self, target_var_name: str) -> Union[int, float, "VphysDict", VphysList, "VphysHex", None]:
         line_index = self.boundary_start + 1
@@ -182,6 +196,8 @@ class VphysDict(VphysContainer):
 
 
 class VphysHex(VphysContainer):
+    __slots__ = ()
+
     def __init__(self, parser: "VphysParser", boundary_start: int) -> None:
         super().__init__(parser, boundary_start)
 
@@ -193,21 +209,60 @@ class VphysHex(VphysContainer):
 
 
 class VphysParser:
-    def __init__(self, content: str) -> None:
+    # concurrent=False: boundary and list caches fill lazily during reads, one thread per parser.
+    # concurrent=True: both are built completely up front and never written again, so any number of threads
+    # can search one parser without locks. container_cache is still filled on demand through dict.setdefault,
+    # which publishes a single wrapper per line atomically; losing a race only costs a discarded wrapper.
+    def __init__(self, content: str, concurrent: bool = False) -> None:
         self.content = content.replace("\t", "").splitlines()
         self.object_boundaries = self.object_boundaries_build(self.content)
+        self.concurrent = concurrent
 
         self.object_boundaries_box_cache: dict[int, int] = dict()
         self.list_index_cache: dict[int, dict[int, tuple[int, int]]] = dict()
+        # one wrapper per boundary line, repeated searches hand out the same object
+        self.container_cache: dict[int, VphysContainer] = dict()
+        if concurrent: self.concurrent_indexes_build()
 
-        self.main_dict = VphysDict(self, tuple(self.object_boundaries.keys())[0])
+        self.main_dict = self.get_container(tuple(self.object_boundaries.keys())[0])
 
 
     @classmethod
-    def from_file_name(cls, file_name: str) -> "VphysParser":
+    def from_file_name(cls, file_name: str, concurrent: bool = False) -> "VphysParser":
         with open(file_name, "r") as vphys_file:
             vphys_content = vphys_file.read()
-            return VphysParser(vphys_content)
+            return VphysParser(vphys_content, concurrent)
+
+
+    def concurrent_indexes_build(self) -> None:
+        # one pass with a stack instead of the per container forward scan of get_boundary_end
+        box_cache: dict[int, int] = dict()
+        prefix_lines = list()
+        for line, boundary_type in self.object_boundaries.items():
+            if boundary_type in (VphysBoundaryType.DICT_PREFIX, VphysBoundaryType.LIST_PREFIX, VphysBoundaryType.HEX_PREFIX):
+                prefix_lines.append(line)
+            else:
+                box_cache.update({prefix_lines.pop(): line})
+
+        list_index_cache: dict[int, dict[int, tuple[int, int]]] = dict()
+        for line, boundary_type in self.object_boundaries.items():
+            if boundary_type != VphysBoundaryType.LIST_PREFIX: continue
+
+            list_index = dict()
+            line_index, read_index = line + 1, 0
+            while line_index < box_cache[line]:
+                if self.is_blank_line(line_index):
+                    line_index += 1
+                    continue
+
+                line_index_next = box_cache.get(line_index, line_index)
+                list_index.update({read_index: (line_index, line_index_next)})
+                read_index += 1
+                line_index = line_index_next + 1
+            list_index_cache.update({line: list_index})
+
+        self.object_boundaries_box_cache = box_cache
+        self.list_index_cache = list_index_cache
 
 
     def get_line_content(self, target_line: int) -> str:
@@ -225,6 +280,19 @@ class VphysParser:
         }.get(content, None)
 
 
+    def get_container(self, target_line: int) -> Union[VphysDict, VphysList, VphysHex, None]:
+        if (container := self.container_cache.get(target_line)) is not None: return container
+
+        container_type = {
+            VphysBoundaryType.DICT_PREFIX: VphysDict,
+            VphysBoundaryType.LIST_PREFIX: VphysList,
+            VphysBoundaryType.HEX_PREFIX: VphysHex,
+        }.get(self.get_boundary_mark_type(target_line), None)
+        if container_type is None: return None
+
+        return self.container_cache.setdefault(target_line, container_type(self, target_line))
+
+
     def is_blank_line(self, target_line: int) -> bool:
         return self.get_line_content(target_line) == ""
 
@@ -247,15 +315,20 @@ class VphysParser:
         return object_boundaries
 
 
-    def search(self, *args: int | str) -> int | float | bytes | None:
-        target_object = self.main_dict
-        for keyword in args:
-            if isinstance(keyword, str):
-                if isinstance(target_object, VphysDict): target_object = target_object.get_var(keyword)
-                if isinstance(target_object, VphysHex): target_object = target_object.get_bytes()
-                if target_object is None: return None
-            elif isinstance(keyword, int):
-                target_object = target_object.get_index(keyword)
-            else: raise ValueError("Keyword %s does not exist." % keyword)
+    @staticmethod
+    def parse_scalar(content: str) -> bool | int | float | str | list:
+        if content.startswith("\"") and content.endswith("\"") and len(content) >= 2:
+            return content[1:-1]
+        elif content.startswith("[") and content.endswith("]"):
+            # one line lists, e.g. m_vCentroid = [ 1.0, 2.0, 3.0 ] or m_bonesHash = [  ]
+            return [VphysParser.parse_scalar(item.strip()) for item in content[1:-1].split(",") if item.strip() != ""]
+        elif content.lower() in ("true", "false"):
+            return content.lower() == "true"
+        elif "." in content:
+            return float(content)
+        else:
+            return int(content)
 
-        return target_object
+
+    def search(self, *args: int | str) -> int | float | str | bytes | None:
+        return self.main_dict.search(*args)